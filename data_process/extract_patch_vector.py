@@ -5,107 +5,249 @@ import os
 import sys
 import time
 import mmap
+import argparse
 from random import shuffle
 import numpy as np
+import torch
 from tqdm import tqdm
-import traceback
 
 cur_path = os.path.dirname(os.path.abspath(__file__))
 base_path = os.path.dirname(cur_path)
 sys.path.insert(0, base_path)
 
-from raw_data_process.aaai_step2_img_to_vec import Img2Vec, get_patch_vector_file
+from raw_data_process.aaai_step2_img_to_vec import Img2Vec, PatchVectorWriter, iter_patch_vector_batches
+from data_process.feature_cache import ImgFeatureCache
+from img_feature_format import IndexWriter, STORAGE_DTYPES
 
 
-def get_img_patch_file(sku_file, img2vec=None):
-    vec_mat = []
-    sku_map = dict()
-    idx = 0
+MULTI_TAP_PREFIX = {'third_last': 'image_patch_vectors_14x14_',
+                    'second_last': 'image_patch_vectors_7x7_',
+                    'pooled': 'image_fc_vectors_'}
+
+
+def get_vec_np_files(out_dir, name, img2vec):
+    """ :returns: the image_patch_vectors_<name> file, or a dict of tap -> file for an Img2Vec with layer 'multi' """
+    if img2vec.layer == 'multi':
+        return {tap: "/".join([out_dir, MULTI_TAP_PREFIX[tap] + name]) for tap in img2vec.taps}
+    return "/".join([out_dir, 'image_patch_vectors_' + name])
+
+
+def read_done_skus(sku_done_file):
+    if not os.path.exists(sku_done_file):
+        return set()
+    return set(line.strip() for line in open(sku_done_file))
+
+
+def extract_sku_patch_vectors(sku_file, img_dir, img_dir_rgb, fout_map, fout_img2ids, fout_sku_err, vec_np_file,
+                              img2vec, batch_size=32, num_workers=4, sku_done_file=None, resume=False,
+                              max_retries=2, checkpoint_interval=20, feature_cache=None, storage_dtype='float32'):
+    """ Extract one patch vector per unique sku of sku_file, in batches.
+    Row i of vec_np_file is the i-th line of sku_map (order of first appearance in sku_file). sku_map and img2ids
+    are written before the backbone runs, together with their binary .bin/.idx index (data_process/img_index.py)
+    that training memory-maps, and vectors are streamed into a .npy memmap, so memory stays flat.
+
+    Every checkpoint_interval batches the memmap is flushed and the written skus are appended to sku_done_file.
+    With resume=True the skus already in sku_done_file are skipped and the others are written into the existing
+    vector file. Skus whose image cannot be read are retried max_retries times, then keep a zero row and are
+    listed in the sku_err file; a later resumed run tries them again.
+
+    With a feature_cache (ImgFeatureCache) images already seen by any other split, part or category are read
+    from the cache instead of going through the backbone.
 
+    storage_dtype 'float16' or 'bfloat16' halves the vector file, see data_process/feature_dtype.py.
+
+    For an Img2Vec with layer 'multi', vec_np_file is a dict of tap -> file (see get_vec_np_files) and every tap
+    is written from the same forward pass.
+    :returns: shape of the vector file, a dict of tap -> shape for layer 'multi'
+    """
+    sku_map = dict()
+    uniq_skus = []
+    for line in open(sku_file):
+        sku = line.strip()
+        if sku not in sku_map:
+            sku_map[sku] = len(uniq_skus)
+            uniq_skus.append(sku)
+            fout_map.write(sku + "\n")
+        fout_img2ids.write(str(sku_map[sku]) + "\n")
+    fout_map.flush()
+    fout_img2ids.flush()
+    with IndexWriter(fout_map.name, np.uint8) as map_writer:
+        for sku in uniq_skus:
+            map_writer.add_str(sku)
+    with IndexWriter(fout_img2ids.name, np.int32) as ids_writer:
+        for line in open(sku_file):
+            ids_writer.add_item([sku_map[line.strip()]])
+
+    done_skus = read_done_skus(sku_done_file) if (resume and sku_done_file) else set()
+    fout_sku_done = open(sku_done_file, "a" if resume else "w") if sku_done_file else None
+
+    # images are converted to RGB in memory by Img2Vec.preprocess, img_rgb is only used when an older
+    # aaai_step1 run left one behind, and it is listed once instead of probed per sku
+    rgb_names = set(os.listdir(img_dir_rgb)) if img_dir_rgb and os.path.isdir(img_dir_rgb) else set()
+    img_files = []
+    for sku in uniq_skus:
+        if sku + '.jpg' in rgb_names:
+            img_files.append(os.path.join(img_dir_rgb, sku + '.jpg'))
+        else:
+            img_files.append(os.path.join(img_dir, sku + '.jpg'))
+
+    multi = isinstance(vec_np_file, dict)
+    vec_np_files = vec_np_file if multi else {None: vec_np_file}
+    writers = {tap: PatchVectorWriter(path, len(uniq_skus), dtype=storage_dtype, resume=resume)
+               for tap, path in vec_np_files.items()}
+    if any(writer.vec_mat is None for writer in writers.values()):
+        # the vector file is gone, whatever sku_done says has to be recomputed
+        done_skus = set()
+    pending = [idx for idx, sku in enumerate(uniq_skus) if sku not in done_skus]
+    if done_skus:
+        sys.stdout.write("Resume {}: {} skus done, {} left\n".format(vec_np_file, len(uniq_skus) - len(pending),
+                                                                     len(pending)))
+
+    def checkpoint(written):
+        for writer in writers.values():
+            writer.flush()
+        if fout_sku_done is not None:
+            for idx in written:
+                fout_sku_done.write(uniq_skus[idx] + "\n")
+            fout_sku_done.flush()
+
+    for attempt in range(max_retries + 1):
+        failed_all = []
+        written = []
+        with tqdm(total=len(pending)) as bar:
+            for step, (positions, vecs, failed) in enumerate(
+                    iter_patch_vector_batches([img_files[idx] for idx in pending], img2vec, batch_size, num_workers,
+                                             feature_cache=feature_cache)):
+                rows = [pending[position] for position in positions]
+                if rows:
+                    for tap, writer in writers.items():
+                        writer.write(rows, vecs[tap] if multi else vecs)
+                    written.extend(rows)
+                failed_all.extend((pending[position], error) for position, error in failed)
+                if (step + 1) % checkpoint_interval == 0:
+                    checkpoint(written)
+                    written = []
+                bar.update(len(positions) + len(failed))
+        checkpoint(written)
+
+        pending = [idx for idx, _ in failed_all]
+        if not pending:
+            break
+        if attempt < max_retries:
+            sys.stderr.write("Retry {} failed skus, attempt {}\n".format(len(pending), attempt + 1))
+            continue
+        for idx, error in failed_all:
+            sys.stderr.write(uniq_skus[idx] + "\t" + error + "\n")
+            fout_sku_err.write(uniq_skus[idx] + "\t" + error + "\n")
+        fout_sku_err.flush()
+
+    for writer in writers.values():
+        writer.close()
+    if fout_sku_done is not None:
+        fout_sku_done.close()
+    if multi:
+        return {tap: writer.shape for tap, writer in writers.items()}
+    return writers[None].shape
+
+
+def get_img_patch_file(sku_file, img2vec=None, batch_size=32, num_workers=4, resume=False, max_retries=2,
+                       feature_cache=None, storage_dtype='float32'):
     file_num = sku_file.split('.')[-2]
     fout_map = open(".".join(sku_file.split('.')[:-1] + ['sku_map']), "w")
     fout_img2ids = open("/".join(sku_file.split('/')[:-2] + ['part_' + str(file_num) + '.img2ids']), "w")
-    fout_sku_err = open("/".join(sku_file.split('/')[:-2] + ['part_' + str(file_num) + '.sku_err']), "w")
+    fout_sku_err = open("/".join(sku_file.split('/')[:-2] + ['part_' + str(file_num) + '.sku_err']),
+                        "a" if resume else "w")
+    sku_done_file = "/".join(sku_file.split('/')[:-2] + ['part_' + str(file_num) + '.sku_done'])
     img_dir = "/".join(sku_file.split('/')[:-3] + ['img'])
     img_dir_rgb = "/".join(sku_file.split('/')[:-3] + ['img_rgb'])
-    vec_np_file = "/".join(sku_file.split('/')[:-2] + ['image_patch_vectors_part_' + str(file_num)])
 
     if not img2vec:
-        img2vec = Img2Vec(cuda=True, model='resnet-101', layer='third_last')
+        img2vec = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer='third_last')
+    vec_np_file = get_vec_np_files("/".join(sku_file.split('/')[:-2]), 'part_' + str(file_num), img2vec)
 
-    for line in tqdm(open(sku_file).readlines()):
-        sku = line.strip()
-        try:
-            img_file = os.path.join(img_dir_rgb, sku + '.jpg')
-            if not os.path.exists(img_file):
-                img_file = os.path.join(img_dir, sku + '.jpg')
-
-            if sku not in sku_map:
-                sku_map[sku] = idx
-                vec = get_patch_vector_file(img_file, img2vec)
-                vec_mat.append(vec)
-                fout_map.write(sku + "\n")
-                idx += 1
-            fout_img2ids.write(str(sku_map[sku]) + "\n")
-        except Exception as error:
-            sys.stderr.write(sku + "\t" + str(error) + "\n")
-            fout_sku_err.write(sku + "\t" + str(error) + "\n")
-
-    vec_mat = np.array(vec_mat).squeeze()
-    np.save(vec_np_file, vec_mat)
+    shape = extract_sku_patch_vectors(sku_file, img_dir, img_dir_rgb, fout_map, fout_img2ids, fout_sku_err,
+                                      vec_np_file, img2vec, batch_size=batch_size, num_workers=num_workers,
+                                      sku_done_file=sku_done_file, resume=resume, max_retries=max_retries,
+                                      feature_cache=feature_cache, storage_dtype=storage_dtype)
 
     fout_map.close()
     fout_img2ids.close()
-    sys.stdout.write("The Task Is Finished! Got Numpy Data: {}, File: {}\n".format(vec_mat.shape, sku_file))
+    fout_sku_err.close()
+    sys.stdout.write("The Task Is Finished! Got Numpy Data: {}, File: {}\n".format(shape, sku_file))
 
 
-def get_img_patch_vec_file(sku_file, img_dir, out_dir, img2vec=None, file_tag=None):
-    vec_mat = []
-    sku_map = dict()
-    idx = 0
+def get_img_patch_vec_file(sku_file, img_dir, out_dir, img2vec=None, file_tag=None, batch_size=32, num_workers=4,
+                           resume=False, max_retries=2, feature_cache=None, storage_dtype='float32'):
     if not file_tag:
         file_tag = sku_file.split('/')[-1].split('.')[0]
     fout_map = open('/'.join([out_dir] + [file_tag + '.sku_map']), "w")
     fout_img2ids = open("/".join([out_dir] + [file_tag + '.img2ids']), "w")
-    fout_sku_err = open("/".join([out_dir] + [file_tag + '.sku_err']), "w")
+    fout_sku_err = open("/".join([out_dir] + [file_tag + '.sku_err']), "a" if resume else "w")
+    sku_done_file = "/".join([out_dir] + [file_tag + '.sku_done'])
 
     img_dir_rgb = "/".join(img_dir.split('/')[:-1] + ['img_rgb'])
-    vec_np_file = "/".join([out_dir] + ['image_patch_vectors_' + str(file_tag)])
 
     if not img2vec:
-        img2vec = Img2Vec(cuda=True, model='resnet-101', layer='third_last')
+        img2vec = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer='third_last')
+    vec_np_file = get_vec_np_files(out_dir, str(file_tag), img2vec)
 
-    for line in tqdm(open(sku_file).readlines()):
-        sku = line.strip()
-        try:
-            img_file = os.path.join(img_dir_rgb, sku + '.jpg')
-            if not os.path.exists(img_file):
-                img_file = os.path.join(img_dir, sku + '.jpg')
-
-            if sku not in sku_map:
-                sku_map[sku] = idx
-                vec = get_patch_vector_file(img_file, img2vec)
-                vec_mat.append(vec)
-                fout_map.write(sku + "\n")
-                idx += 1
-            fout_img2ids.write(str(sku_map[sku]) + "\n")
-        except Exception as error:
-            sys.stderr.write(sku + "\t" + str(traceback.format_exc()) + "\n")
-            fout_sku_err.write(sku + "\t" + str(traceback.format_exc()) + "\n")
-
-    vec_mat = np.array(vec_mat).squeeze()
-    np.save(vec_np_file, vec_mat)
+    shape = extract_sku_patch_vectors(sku_file, img_dir, img_dir_rgb, fout_map, fout_img2ids, fout_sku_err,
+                                      vec_np_file, img2vec, batch_size=batch_size, num_workers=num_workers,
+                                      sku_done_file=sku_done_file, resume=resume, max_retries=max_retries,
+                                      feature_cache=feature_cache, storage_dtype=storage_dtype)
 
     fout_map.close()
     fout_img2ids.close()
-    sys.stdout.write("The Task Is Finished! Got Numpy Data: {}, File: {}\n".format(vec_mat.shape, sku_file))
+    fout_sku_err.close()
+    sys.stdout.write("The Task Is Finished! Got Numpy Data: {}, File: {}\n".format(shape, sku_file))
 
 
 if __name__ == "__main__":
-
-    sku_file = sys.argv[1]
-    img_dir = sys.argv[2]
-    out_dir = sys.argv[3]
-    file_tag = sys.argv[4]
-
-    get_img_patch_vec_file(sku_file, img_dir, out_dir, file_tag=file_tag)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sku_file", type=str, help="one sku per line")
+    parser.add_argument("img_dir", type=str, help="dir of <sku>.jpg images")
+    parser.add_argument("out_dir", type=str)
+    parser.add_argument("file_tag", type=str)
+    parser.add_argument("--batch-size", type=int, default=32, help="images per backbone forward")
+    parser.add_argument("--num-workers", type=int, default=4, help="decode/resize worker processes")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="skip the skus listed in <file_tag>.sku_done by a previous run")
+    parser.add_argument("--max-retries", type=int, default=2, help="retries for skus whose image fails")
+    parser.add_argument("--feature-cache-dir", type=str, default=None,
+                        help="image feature cache shared across splits/parts/categories")
+    parser.add_argument("--feature-cache-size-gb", type=float, default=200.0)
+    parser.add_argument("--cpu-mode", choices=['fp32', 'bf16', 'int8'], default=None,
+                        help="optimized CPU backbone, check it first with raw_data_process/check_img2vec_tolerance.py")
+    parser.add_argument("--calib-num", type=int, default=64, help="images used to calibrate --cpu-mode int8")
+    parser.add_argument("--draft", action="store_true", default=False,
+                        help="decode JPEGs at reduced resolution, check the drift with check_img2vec_tolerance.py")
+    parser.add_argument("--taps", nargs="+", choices=['third_last', 'second_last', 'pooled'], default=None,
+                        help="write several layers from one forward pass: 14x14x1024, 7x7x2048 and pooled 2048 "
+                             "vectors, into image_patch_vectors_14x14_/image_patch_vectors_7x7_/image_fc_vectors_ files")
+    parser.add_argument("--storage-dtype", choices=STORAGE_DTYPES, default='float32',
+                        help="dtype of the vector files, float16/bfloat16 halve them; check the loss with "
+                             "data_process/feature_dtype.py --validate")
+    args = parser.parse_args()
+    if args.cpu_mode and args.taps:
+        parser.error("--cpu-mode builds a single third_last backbone, it can not be combined with --taps")
+    if args.feature_cache_dir and args.taps:
+        parser.error("the feature cache only supports single layer extractors, it can not be combined with --taps")
+
+    if args.cpu_mode:
+        calib_skus = [line.strip() for _, line in zip(range(args.calib_num), open(args.sku_file))]
+        img2vec = Img2Vec(cuda=False, model='resnet-101', layer='third_last', cpu_mode=args.cpu_mode,
+                          calib_files=[os.path.join(args.img_dir, sku + '.jpg') for sku in calib_skus],
+                          draft=args.draft)
+    elif args.taps:
+        img2vec = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer='multi', draft=args.draft,
+                          taps=args.taps)
+    else:
+        img2vec = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer='third_last', draft=args.draft)
+    feature_cache = None
+    if args.feature_cache_dir:
+        feature_cache = ImgFeatureCache(args.feature_cache_dir, img2vec.config_key, args.feature_cache_size_gb)
+
+    get_img_patch_vec_file(args.sku_file, args.img_dir, args.out_dir, img2vec=img2vec, file_tag=args.file_tag,
+                           batch_size=args.batch_size, num_workers=args.num_workers,
+                           resume=args.resume, max_retries=args.max_retries, feature_cache=feature_cache,
+                           storage_dtype=args.storage_dtype)
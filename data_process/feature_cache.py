@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" 图片特征缓存
+
+Image feature cache shared by every split, part and category.
+Entries are keyed by the sha1 of the image file content, under a directory keyed by the backbone config
+(Img2Vec.config_key), so a sku image that was already run through the same backbone is never run again.
+The least recently used entries are evicted once the cache grows over max_size_gb.
+"""
+
+import os
+import sys
+import hashlib
+import numpy as np
+
+
+class ImgFeatureCache(object):
+
+    def __init__(self, cache_dir, config_key, max_size_gb=200.0):
+        """ ImgFeatureCache
+        :param cache_dir: root dir of the cache, can be shared by several extraction jobs
+        :param config_key: String describing the backbone/layer/preprocessing that produced the vectors
+        :param max_size_gb: size budget of this config's entries
+        """
+        self.root = os.path.join(cache_dir, hashlib.sha1(config_key.encode('utf-8')).hexdigest()[:16])
+        self.config_key = config_key
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+            with open(os.path.join(self.root, 'config'), 'w') as f:
+                f.write(config_key + "\n")
+        self.size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def content_key(img_bytes):
+        return hashlib.sha1(img_bytes).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def _entries(self):
+        for sub_dir in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for name in os.listdir(sub_path):
+                if not name.endswith('.npy'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(sub_path, name))
+                except FileNotFoundError:
+                    continue
+                yield os.path.join(sub_path, name), stat.st_mtime, stat.st_size
+
+    def get(self, key):
+        """ :returns: the cached numpy vector of an image content key, or None """
+        path = self._path(key)
+        try:
+            vec = np.load(path)
+            # mtime is the recency used by evict()
+            os.utime(path, None)
+            return vec
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def put(self, key, vec):
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, vec)
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self, target_ratio=0.9):
+        """ Remove least recently used entries until the cache is below target_ratio of its budget """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+        removed = 0
+        for path, _, size in entries:
+            if self.size <= self.max_size * target_ratio:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            removed += 1
+        sys.stdout.write("Feature cache {} evicted {} entries, size: {:.2f} GB\n".format(
+            self.root, removed, self.size / 1024. ** 3))
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" 图片特征压缩 (PCA / PQ)
+
+The model projects every patch through img_Linear right away, so the raw 2048 (or 1024) dims carry much
+more precision than it uses. This compresses an image_patch_vectors_*.npy matrix offline:
+- pca: k principal components per patch, stored in a float16/bfloat16/float32 .npy
+- pq: product quantization, m uint8 codes per patch (m sub-spaces of 256 centroids each)
+The codec (mean/components or codebooks) is saved next to the codes as <codes>.codec.npz and
+IndexedImgDataset decodes rows per batch when it finds it. With pca and --patch_embed_size k the codes are fed
+to the model as they are, without decoding.
+
+python feature_codec.py image_patch_vectors_part_0.npy image_patch_vectors_part_0.pca256.npy --kind pca --k 256
+python feature_codec.py image_patch_vectors_part_0.npy image_patch_vectors_part_0.pq64.npy --kind pq --m 64
+add --validate --checkpoint ... --data ... to compare the loss of a trained checkpoint, see feature_dtype.py
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+if base_path not in sys.path:
+    sys.path.insert(0, base_path)
+
+from img_feature_format import STORAGE_DTYPES, FeatureCodec, codec_path, nearest_centroid, storage_np_dtype, \
+    to_float32, to_storage
+from data_process.feature_dtype import validate_loss
+
+
+def sample_patches(vec_mat, max_patches=200000, seed=1):
+    """ Random patches (max_patches, feature_size) of a (row_num, patch_num, feature_size) matrix """
+    rng = np.random.RandomState(seed)
+    patch_num = vec_mat.shape[1]
+    rows = np.sort(rng.choice(len(vec_mat), min(len(vec_mat), max(1, max_patches // patch_num)), replace=False))
+    return to_float32(np.asarray(vec_mat[rows])).reshape(-1, vec_mat.shape[-1])
+
+
+def fit_pca(samples, k):
+    mean = samples.mean(0)
+    _, _, vt = np.linalg.svd(samples - mean, full_matrices=False)
+    return FeatureCodec('pca', mean=mean.astype(np.float32), components=vt[:k].astype(np.float32))
+
+
+def fit_pq(samples, m, ks=256, iters=20, seed=1):
+    assert samples.shape[1] % m == 0, "feature size {} is not divisible by m={}".format(samples.shape[1], m)
+    rng = np.random.RandomState(seed)
+    dsub = samples.shape[1] // m
+    codebooks = np.empty((m, ks, dsub), dtype=np.float32)
+    for j in range(m):
+        sub = samples[:, j * dsub: (j + 1) * dsub]
+        centroids = sub[rng.choice(len(sub), ks, replace=len(sub) < ks)].copy()
+        for _ in range(iters):
+            assign = nearest_centroid(sub, centroids)
+            counts = np.bincount(assign, minlength=ks)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sub)
+            # empty clusters keep their centroid
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled][:, None]
+        codebooks[j] = centroids
+    return FeatureCodec('pq', codebooks=codebooks)
+
+
+def compress_file(src_file, dst_file, kind='pca', k=256, m=64, dtype='float16', max_patches=200000, chunk_rows=1024):
+    """ Fit a codec on a sample of src_file, write the codes to dst_file and the codec next to it
+    :returns: codec, compression ratio, relative reconstruction error on the sample
+    """
+    src = np.load(src_file, mmap_mode='r')
+    samples = sample_patches(src, max_patches)
+    codec = fit_pca(samples, k) if kind == 'pca' else fit_pq(samples, m)
+    code_dtype = storage_np_dtype(dtype) if kind == 'pca' else np.dtype(np.uint8)
+    dst = np.lib.format.open_memmap(dst_file, mode='w+', dtype=code_dtype, shape=src.shape[:-1] + (codec.code_dim,))
+    for start in range(0, len(src), chunk_rows):
+        codes = codec.encode(to_float32(np.asarray(src[start: start + chunk_rows])))
+        dst[start: start + chunk_rows] = to_storage(codes, dtype) if kind == 'pca' else codes
+    dst.flush()
+    codec.save(codec_path(dst_file))
+
+    ratio = os.path.getsize(src_file) / float(os.path.getsize(dst_file) + os.path.getsize(codec_path(dst_file)))
+    decoded = codec.decode(codec.encode(samples))
+    rel_err = float(((decoded - samples) ** 2).sum() / ((samples - samples.mean(0)) ** 2).sum())
+    sys.stdout.write("{} {} -> {} {}, compression ratio: {:.1f}x, relative reconstruction error: {:.4f}\n".format(
+        src_file, src.shape, dst_file, dst.shape, ratio, rel_err))
+    return codec, ratio, rel_err
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src_file", type=str, help="image_patch_vectors_*.npy to compress")
+    parser.add_argument("dst_file", type=str)
+    parser.add_argument("--kind", choices=['pca', 'pq'], default='pca')
+    parser.add_argument("--k", type=int, default=256, help="pca components per patch")
+    parser.add_argument("--m", type=int, default=64, help="pq sub-spaces per patch (one uint8 code each)")
+    parser.add_argument("--dtype", choices=STORAGE_DTYPES, default='float16', help="storage dtype of pca codes")
+    parser.add_argument("--max-patches", type=int, default=200000, help="patches sampled to fit the codec")
+    parser.add_argument("--validate", action="store_true", default=False,
+                        help="compare the loss of --checkpoint on held-out batches with both files")
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--data", type=str, default=None, help="data-bin dir of the checkpoint's task")
+    parser.add_argument("--split", type=str, default='valid')
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--user-dir", type=str, default=None)
+    args = parser.parse_args()
+
+    compress_file(args.src_file, args.dst_file, args.kind, args.k, args.m, args.dtype, args.max_patches)
+    if args.validate:
+        validate_loss(args.checkpoint, args.data, args.split, args.src_file, args.dst_file, args.batches,
+                      args.max_tokens, args.user_dir)
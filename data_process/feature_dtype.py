@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" 图片特征半精度存储
+
+Storage dtypes of the image_patch_vectors_*.npy matrices. float16 files are plain float16 .npy files,
+numpy has no bfloat16 so bfloat16 files keep the upper 16 bits of every float32 in a uint16 .npy
+(a dtype no real feature matrix uses). IndexedImgDataset keeps rows in the storage dtype and upcasts
+to float32 per batch.
+
+Convert an existing float32 matrix, then compare the downstream loss on held-out batches:
+python feature_dtype.py image_patch_vectors_valid.npy image_patch_vectors_valid.fp16.npy --dtype float16
+python feature_dtype.py image_patch_vectors_valid.npy image_patch_vectors_valid.fp16.npy --dtype float16 \
+    --validate --checkpoint checkpoints/checkpoint_best.pt --data data-bin --split valid --batches 20
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+if base_path not in sys.path:
+    sys.path.insert(0, base_path)
+
+from img_feature_format import STORAGE_DTYPES, storage_np_dtype, storage_name, to_storage, to_float32
+
+
+def convert_file(src_file, dst_file, dtype, chunk_rows=4096):
+    """ Write src_file in another storage dtype, chunk by chunk so memory stays flat """
+    src = np.load(src_file, mmap_mode='r')
+    dst = np.lib.format.open_memmap(dst_file, mode='w+', dtype=storage_np_dtype(dtype), shape=src.shape)
+    for start in range(0, len(src), chunk_rows):
+        dst[start: start + chunk_rows] = to_storage(to_float32(np.asarray(src[start: start + chunk_rows])), dtype)
+    dst.flush()
+    sys.stdout.write("{} {} ({:.2f} GB) -> {} {} ({:.2f} GB)\n".format(
+        src_file, storage_name(src.dtype), os.path.getsize(src_file) / 1024. ** 3,
+        dst_file, dtype, os.path.getsize(dst_file) / 1024. ** 3))
+    return dst.shape
+
+
+def validate_loss(checkpoint, data, split, src_file, dst_file, batches=20, max_tokens=4096, user_dir=None):
+    """ Mean criterion loss of a trained checkpoint on the first held-out batches of split, with the image
+    features read from src_file and then from dst_file
+    """
+    import torch
+    from fairseq import checkpoint_utils, utils
+
+    user_dir = user_dir or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model')
+    utils.import_user_module(argparse.Namespace(user_dir=user_dir))
+    models, model_args, task = checkpoint_utils.load_model_ensemble_and_task(
+        [checkpoint], arg_overrides={'data': data, 'img2vec_path': src_file})
+    model = models[0].eval()
+    use_cuda = torch.cuda.is_available()
+    if use_cuda:
+        model.cuda()
+    criterion = task.build_criterion(model_args)
+    task.load_dataset(split)
+    dataset = task.dataset(split)
+
+    def mean_loss():
+        itr = task.get_batch_iterator(dataset=dataset, max_tokens=max_tokens, seed=1).next_epoch_itr(shuffle=False)
+        total, sample_size = 0., 0
+        with torch.no_grad():
+            for step, sample in enumerate(itr):
+                if step >= batches:
+                    break
+                sample = utils.move_to_cuda(sample) if use_cuda else sample
+                loss, size, _ = criterion(model, sample)
+                total += float(loss)
+                sample_size += size
+        return total / max(sample_size, 1)
+
+    src_loss = mean_loss()
+    dataset.img_vec.read_data(dst_file, dataset.img_vec.img2ids_path)
+    dst_loss = mean_loss()
+    sys.stdout.write("[{}] loss with {}: {:.6f}, with {}: {:.6f}, delta: {:+.6f}\n".format(
+        split, src_file, src_loss, dst_file, dst_loss, dst_loss - src_loss))
+    return src_loss, dst_loss
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("src_file", type=str, help="image_patch_vectors_*.npy to convert")
+    parser.add_argument("dst_file", type=str)
+    parser.add_argument("--dtype", choices=STORAGE_DTYPES, default='float16')
+    parser.add_argument("--validate", action="store_true", default=False,
+                        help="compare the loss of --checkpoint on held-out batches with both files")
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--data", type=str, default=None, help="data-bin dir of the checkpoint's task")
+    parser.add_argument("--split", type=str, default='valid')
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--user-dir", type=str, default=None)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.dst_file):
+        convert_file(args.src_file, args.dst_file, args.dtype)
+    if args.validate:
+        validate_loss(args.checkpoint, args.data, args.split, args.src_file, args.dst_file, args.batches,
+                      args.max_tokens, args.user_dir)
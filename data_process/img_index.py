@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" img2ids/sku_map 二进制索引
+
+Binary version of the img2ids and sku_map text files, in the spirit of fairseq's mmap indexed_dataset:
+<path>.bin holds the flat values of every line (int32 img ids, or the utf-8 bytes of a sku) and <path>.idx
+holds a small header and the int64 line offsets. Both are memory-mapped at load, so a multi-million-line
+img2ids is available without parsing text. The reader and writer live in img_feature_format.py at the
+repo root, shared with the training code.
+
+The extraction step writes them next to the text files, existing text files can be converted with
+python img_index.py bpe_mg_batch/part_0.img2ids
+python img_index.py bpe_mg_batch/part_0.sku_map --str
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+if base_path not in sys.path:
+    sys.path.insert(0, base_path)
+
+from img_feature_format import IndexWriter, data_file_path, index_file_path
+
+
+def binarize_text(path, as_str=False, dtype=np.int32):
+    """ Write the binary index of an existing img2ids (space separated ids) or sku_map (as_str) text file """
+    with IndexWriter(path, np.uint8 if as_str else dtype) as writer:
+        for line in open(path, "r", encoding="utf-8"):
+            if as_str:
+                writer.add_str(line.rstrip('\n'))
+            else:
+                writer.add_item([int(idx) for idx in line.split()])
+    return len(writer.offsets) - 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="img2ids or sku_map text files")
+    parser.add_argument("--str", action="store_true", default=False, help="lines are strings (sku_map)")
+    args = parser.parse_args()
+
+    for path in args.files:
+        line_num = binarize_text(path, as_str=args.str)
+        sys.stdout.write("{}: {} lines -> {}, {}\n".format(path, line_num, data_file_path(path),
+                                                         index_file_path(path)))
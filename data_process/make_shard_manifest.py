@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" 生成 --img-manifest 分片清单
+
+Write the shard manifest read by the matchgo task with --img-manifest, for the --is_multi_files layout:
+<root>/bpe_mg/part<N> (binarized token data of train shard N), <root>/bpe_mg_batch/part_<N>.img2ids and
+<root>/bpe_mg_batch/image_patch_vectors_part_<N>.npy, plus valid/test with the first data dir.
+
+python make_shard_manifest.py /data/xxx/jdsum/home_appliances/bpe_mg/part0:/data/xxx/jdsum/home_appliances/bpe_mg/part1 \
+    /data/xxx/jdsum/home_appliances/manifest.json
+
+{"train": [{"data": ..., "img2ids": ..., "img2vec": ..., "examples": 1000000, "rows": 800000}, ...],
+ "valid": [...], "test": [...]}
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+sys.path.insert(0, base_path)
+
+from img_feature_format import ImgIndex, index_exists
+
+
+def count_lines(img2ids_path):
+    if index_exists(img2ids_path):
+        return len(ImgIndex(img2ids_path))
+    with open(img2ids_path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def describe_shard(data, img2ids, img2vec):
+    shard = {"data": data, "img2ids": img2ids, "img2vec": img2vec}
+    if os.path.exists(img2ids):
+        shard["examples"] = count_lines(img2ids)
+    else:
+        sys.stderr.write("missing {}\n".format(img2ids))
+    if os.path.exists(img2vec):
+        shard["rows"] = int(np.load(img2vec, mmap_mode='r').shape[0])
+    else:
+        sys.stderr.write("missing {}\n".format(img2vec))
+    return shard
+
+
+def multi_files_manifest(data_paths):
+    """ Manifest of the paths --is_multi_files derives from the data dirs """
+    manifest = {"train": []}
+    for data_path in data_paths:
+        batch_dir = '/'.join(data_path.rstrip('/').split('/')[:-2] + ['bpe_mg_batch'])
+        part_num = int(data_path.rstrip('/').split('part')[-1])
+        manifest["train"].append(describe_shard(
+            data_path, batch_dir + '/part_' + str(part_num) + '.img2ids',
+            batch_dir + '/image_patch_vectors_part_' + str(part_num) + '.npy'))
+    batch_dir = '/'.join(data_paths[0].rstrip('/').split('/')[:-2] + ['bpe_mg_batch'])
+    for split in ('valid', 'test'):
+        manifest[split] = [describe_shard(data_paths[0], batch_dir + '/' + split + '.img2ids',
+                                          batch_dir + '/image_patch_vectors_' + split + '.npy')]
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", type=str, help="colon separated train data dirs, as given to fairseq-train")
+    parser.add_argument("manifest", type=str, help="output json")
+    args = parser.parse_args()
+
+    manifest = multi_files_manifest(args.data.split(':'))
+    with open(args.manifest, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    sys.stdout.write("{}: {} train shards\n".format(args.manifest, len(manifest["train"])))
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" 图片特征存储格式
+
+On-disk formats of the image stores, read by IndexedImgDataset at training time and written by the
+data_process tools (img_index.py, feature_dtype.py, feature_codec.py). It only needs numpy and sits at the repo
+root, out of the model package, so the extraction tools do not import fairseq and the training stack with it:
+- <path>.bin/<path>.idx: binary img2ids and sku_map, <path>.bin holds the flat values of every line and
+  <path>.idx a small header and the int64 line offsets, both memory-mapped at load
+- storage dtypes of the feature matrices: float32, float16, and bfloat16 kept as the upper 16 bits of every
+  float32 in a uint16 .npy (a dtype no real feature matrix uses)
+- <codes>.codec.npz: the PCA/PQ codec of a compressed feature matrix
+"""
+
+import os
+import struct
+from array import array
+import numpy as np
+
+_HDR_MAGIC = b'IMGIDX\x00\x00'
+_VERSION = 1
+_DTYPES = {1: np.uint8, 4: np.int32, 5: np.int64}
+_HDR_FMT = '<QBQ'
+# the header is padded so the int64 offsets stay 8-byte aligned in the mmap
+_HDR_SIZE = 32
+
+
+def _dtype_code(dtype):
+    for code, value in _DTYPES.items():
+        if np.dtype(value) == np.dtype(dtype):
+            return code
+    raise ValueError("unsupported index dtype: {}".format(dtype))
+
+
+def data_file_path(path):
+    return path + '.bin'
+
+
+def index_file_path(path):
+    return path + '.idx'
+
+
+def index_exists(path):
+    """ True when the binary index of the text file path exists and is not older than the text file """
+    if not (os.path.exists(data_file_path(path)) and os.path.exists(index_file_path(path))):
+        return False
+    if os.path.exists(path):
+        return os.path.getmtime(index_file_path(path)) >= os.path.getmtime(path)
+    return True
+
+
+class IndexWriter(object):
+    """ Streams lines into <path>.bin, the offsets are written to <path>.idx on close """
+
+    def __init__(self, path, dtype=np.int32):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.data_file = open(data_file_path(path), 'wb')
+        self.offsets = array('q', [0])
+
+    def add_item(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.data_file.write(values.tobytes())
+        self.offsets.append(self.offsets[-1] + len(values))
+
+    def add_str(self, s):
+        self.add_item(np.frombuffer(s.encode('utf-8'), dtype=np.uint8))
+
+    def close(self):
+        self.data_file.close()
+        tmp_path = index_file_path(self.path) + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_HDR_MAGIC)
+            f.write(struct.pack(_HDR_FMT, _VERSION, _dtype_code(self.dtype), len(self.offsets) - 1))
+            f.write(b'\x00' * (_HDR_SIZE - len(_HDR_MAGIC) - struct.calcsize(_HDR_FMT)))
+            f.write(np.frombuffer(self.offsets, dtype=np.int64).tobytes())
+        # the .idx appears last, so a crashed writer never leaves an index that looks complete
+        os.replace(tmp_path, index_file_path(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ImgIndex(object):
+    """ Memory-mapped reader of an IndexWriter output, line i is data[offsets[i]:offsets[i + 1]] """
+
+    def __init__(self, path):
+        with open(index_file_path(path), 'rb') as f:
+            magic = f.read(len(_HDR_MAGIC))
+            assert magic == _HDR_MAGIC, "{} is not an img index file".format(index_file_path(path))
+            version, dtype_code, line_num = struct.unpack(_HDR_FMT, f.read(struct.calcsize(_HDR_FMT)))
+            assert version == _VERSION, "unsupported img index version {}".format(version)
+        self.dtype = np.dtype(_DTYPES[dtype_code])
+        self.offsets = np.memmap(index_file_path(path), dtype=np.int64, mode='r', offset=_HDR_SIZE,
+                                 shape=(line_num + 1,))
+        if os.path.getsize(data_file_path(path)) > 0:
+            self.data = np.memmap(data_file_path(path), dtype=self.dtype, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def get_str(self, i):
+        return self[i].tobytes().decode('utf-8')
+
+
+STORAGE_DTYPES = ('float32', 'float16', 'bfloat16')
+BF16_STORAGE = np.dtype(np.uint16)
+
+
+def storage_np_dtype(dtype):
+    """ numpy dtype that holds a storage dtype name (or numpy dtype) on disk """
+    if dtype == 'bfloat16':
+        return BF16_STORAGE
+    return np.dtype(dtype)
+
+
+def storage_name(np_dtype):
+    """ Storage dtype name of a feature matrix dtype """
+    if np.dtype(np_dtype) == BF16_STORAGE:
+        return 'bfloat16'
+    return np.dtype(np_dtype).name
+
+
+def to_storage(vecs, dtype):
+    """ Cast float32 vectors to the storage dtype, bfloat16 is rounded to nearest even """
+    if storage_np_dtype(dtype) != BF16_STORAGE:
+        return vecs.astype(storage_np_dtype(dtype), copy=False)
+    bits = np.ascontiguousarray(vecs, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7fff)
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def to_float32(vecs):
+    """ Upcast rows read in any storage dtype to float32 """
+    if vecs.dtype == BF16_STORAGE:
+        return (vecs.astype(np.uint32) << 16).view(np.float32)
+    return vecs.astype(np.float32, copy=False)
+
+
+def codec_path(codes_file):
+    return (codes_file[:-4] if codes_file.endswith('.npy') else codes_file) + '.codec.npz'
+
+
+class FeatureCodec(object):
+
+    def __init__(self, kind, mean=None, components=None, codebooks=None):
+        """ FeatureCodec
+        :param kind: 'pca' or 'pq'
+        :param mean: pca mean (feature_size,)
+        :param components: pca components (k, feature_size)
+        :param codebooks: pq centroids (m, 256, feature_size / m)
+        """
+        self.kind = kind
+        self.mean = mean
+        self.components = components
+        self.codebooks = codebooks
+
+    @property
+    def code_dim(self):
+        return len(self.components) if self.kind == 'pca' else len(self.codebooks)
+
+    @property
+    def out_dim(self):
+        return self.components.shape[1] if self.kind == 'pca' else self.codebooks.shape[0] * self.codebooks.shape[2]
+
+    def encode(self, vecs):
+        """ (..., feature_size) float32 -> (..., code_dim) float32 pca codes or uint8 pq codes """
+        if self.kind == 'pca':
+            return np.dot(vecs - self.mean, self.components.T).astype(np.float32)
+        m, ks, dsub = self.codebooks.shape
+        sub = vecs.reshape(-1, m, dsub)
+        codes = np.empty((len(sub), m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = nearest_centroid(sub[:, j], self.codebooks[j])
+        return codes.reshape(vecs.shape[:-1] + (m,))
+
+    def decode(self, codes):
+        """ codes read from the store -> (..., feature_size) float32 """
+        if self.kind == 'pca':
+            return np.dot(to_float32(codes), self.components) + self.mean
+        m = len(self.codebooks)
+        vecs = self.codebooks[np.arange(m), codes.astype(np.int64)]
+        return vecs.reshape(codes.shape[:-1] + (-1,))
+
+    def save(self, path):
+        if self.kind == 'pca':
+            np.savez(path, kind=self.kind, mean=self.mean, components=self.components)
+        else:
+            np.savez(path, kind=self.kind, codebooks=self.codebooks)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        kind = str(data['kind'])
+        if kind == 'pca':
+            return cls(kind, mean=data['mean'], components=data['components'])
+        return cls(kind, codebooks=data['codebooks'])
+
+
+def nearest_centroid(x, centroids):
+    dist = (centroids ** 2).sum(-1)[None, :] - 2 * np.dot(x, centroids.T)
+    return dist.argmin(-1)
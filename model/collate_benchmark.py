@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+""" matchgo collater 吞吐测试
+
+Micro-benchmark of LanguagePairDataset.collater on synthetic data: random source/target tokens and a random
+image store memory-mapped from a temporary .npy, batched like training. Run from the repo root:
+
+python -m model.collate_benchmark --examples 20000 --batch-size 64 --patch-num 49 --feature-size 2048
+python -m model.collate_benchmark --img-pooling concat --max-images 3
+python -m model.collate_benchmark --check  # gather/gather_concat from float32/float16/bfloat16/pca/pq stores against the rows
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import torch
+from fairseq.data.dictionary import Dictionary
+
+from .language_pair_dataset import LanguagePairDataset
+from .matchgo_task import IndexedImgDataset
+from img_feature_format import FeatureCodec, codec_path, to_float32, to_storage
+
+CHECK_STORES = ("float32", "float16", "bfloat16", "pca", "pq")
+
+
+def build_dataset(tmp_dir, examples, patch_num, feature_size, max_images=1, img_pooling="mean", seed=1):
+    rng = np.random.RandomState(seed)
+    src_dict = Dictionary()
+    for i in range(1000):
+        src_dict.add_symbol(str(i))
+    src_sizes = rng.randint(20, 400, size=examples)
+    tgt_sizes = rng.randint(10, 100, size=examples)
+    src = [torch.from_numpy(rng.randint(4, len(src_dict), size=n)) for n in src_sizes]
+    tgt = [torch.from_numpy(rng.randint(4, len(src_dict), size=n)) for n in tgt_sizes]
+
+    row_num = max(1, examples // 2)
+    img2vec_path = os.path.join(tmp_dir, "image_patch_vectors.npy")
+    vec_mat = np.lib.format.open_memmap(img2vec_path, mode="w+", dtype=np.float32,
+                                        shape=(row_num, patch_num, feature_size))
+    for start in range(0, row_num, 1024):
+        vec_mat[start: start + 1024] = rng.rand(min(1024, row_num - start), patch_num, feature_size)
+    vec_mat.flush()
+    img2ids_path = os.path.join(tmp_dir, "train.img2ids")
+    with open(img2ids_path, "w") as f:
+        for _ in range(examples):
+            f.write(" ".join(str(idx) for idx in rng.randint(0, row_num, size=rng.randint(1, max_images + 1))) + "\n")
+    img_vec = IndexedImgDataset(img2vec_path=img2vec_path, img2ids_path=img2ids_path)
+    return LanguagePairDataset(src, src_sizes, src_dict, tgt, tgt_sizes, src_dict, img_vec=img_vec,
+                               img_pooling=img_pooling)
+
+
+def build_check_store(tmp_dir, kind, row_num=6, patch_num=3, feature_size=8, seed=1):
+    """ A small store of the given kind (storage dtype or codec) and the float32 rows it decodes to """
+    rng = np.random.RandomState(seed)
+    img2vec_path = os.path.join(tmp_dir, "image_patch_vectors_{}.npy".format(kind))
+    if kind == "pca":
+        codec = FeatureCodec("pca", mean=rng.rand(feature_size).astype(np.float32),
+                             components=rng.rand(feature_size // 2, feature_size).astype(np.float32))
+        stored = to_storage(rng.rand(row_num, patch_num, codec.code_dim).astype(np.float32), "float16")
+    elif kind == "pq":
+        codec = FeatureCodec("pq", codebooks=rng.rand(2, 256, feature_size // 2).astype(np.float32))
+        stored = rng.randint(0, 256, size=(row_num, patch_num, 2)).astype(np.uint8)
+    else:
+        codec = None
+        stored = to_storage(rng.rand(row_num, patch_num, feature_size).astype(np.float32) * 1000, kind)
+    np.save(img2vec_path, stored)
+    if codec is not None:
+        codec.save(codec_path(img2vec_path))
+    return img2vec_path, to_float32(stored) if codec is None else codec.decode(stored)
+
+
+def check_gather(tmp_dir):
+    """ Compare gather and gather_concat with fresh and preallocated outputs to the decoded rows, for every
+    store kind """
+    lines = [[0], [1, 2], [4], [3, 0, 1], [5]]
+    img2ids_path = os.path.join(tmp_dir, "check.img2ids")
+    with open(img2ids_path, "w") as f:
+        for line in lines:
+            f.write(" ".join(str(idx) for idx in line) + "\n")
+    for kind in CHECK_STORES:
+        img2vec_path, rows = build_check_store(tmp_dir, kind)
+        store = IndexedImgDataset(img2vec_path=img2vec_path, img2ids_path=img2ids_path)
+        for ids in ([0, 2, 4], [1, 3, 0]):
+            expected = np.stack([rows[lines[i]].mean(0) for i in ids])
+            out = np.full_like(expected, np.nan)
+            for gathered in (store.gather(ids), store.gather(ids, out=out)):
+                assert np.allclose(gathered, expected, rtol=1e-5, atol=1e-3), "gather {} from a {} store".format(
+                    ids, kind)
+            # --img-pooling concat, with every image and with one image per line
+            for counts in (store.image_counts(ids), np.ones(len(ids), dtype=np.int64)):
+                expected = np.zeros((len(ids), counts.max() * rows.shape[1], rows.shape[2]), dtype=np.float32)
+                for i, (idx, count) in enumerate(zip(ids, counts)):
+                    expected[i, :count * rows.shape[1]] = rows[lines[idx][:count]].reshape(-1, rows.shape[2])
+                out = np.full_like(expected, np.nan)
+                for gathered in (store.gather_concat(ids, counts), store.gather_concat(ids, counts, out=out)):
+                    assert np.allclose(gathered, expected, rtol=1e-5, atol=1e-3), \
+                        "gather_concat {} {} from a {} store".format(ids, counts, kind)
+        print("{} store: ok".format(kind))
+
+
+def benchmark(dataset, batch_size=64, batches=200, warmup=10):
+    """ :returns: collated samples per second, milliseconds per batch """
+    indices = dataset.ordered_indices()
+    batch_indices = [indices[i: i + batch_size] for i in range(0, len(indices), batch_size)][:batches + warmup]
+    samples = [[dataset[int(idx)] for idx in batch] for batch in batch_indices]
+    for batch in samples[:warmup]:
+        dataset.collater(batch)
+    t0 = time.time()
+    for batch in samples[warmup:]:
+        dataset.collater(batch)
+    seconds = time.time() - t0
+    collated = sum(len(batch) for batch in samples[warmup:])
+    return collated / seconds, seconds * 1000. / max(1, len(samples) - warmup)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--examples", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--patch-num", type=int, default=49)
+    parser.add_argument("--feature-size", type=int, default=2048)
+    parser.add_argument("--img-pooling", choices=["mean", "concat"], default="mean")
+    parser.add_argument("--max-images", type=int, default=1, help="images listed per img2ids line, at most")
+    parser.add_argument("--check", action="store_true", default=False,
+                        help="only check the gathered features of every store kind")
+    args = parser.parse_args()
+
+    if args.check:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            check_gather(tmp_dir)
+    else:
+        torch.set_num_threads(1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dataset = build_dataset(tmp_dir, args.examples, args.patch_num, args.feature_size, args.max_images,
+                                    args.img_pooling)
+            samples_per_second, ms_per_batch = benchmark(dataset, args.batch_size, args.batches)
+            print("collate: {:.0f} samples/s, {:.2f} ms per batch of {} ({} pooling, {}x{} patches)".format(
+                samples_per_second, ms_per_batch, args.batch_size, args.img_pooling, args.patch_num,
+                args.feature_size))
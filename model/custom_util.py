@@ -3,20 +3,56 @@
 
 import torch
 import os
+import fcntl
+import shutil
+import hashlib
 import psutil
 import torch.nn as nn
+from fairseq.data.iterators import CountingIterator
 
 import time
 from functools import wraps
 
 
 def show_memory_info(hint):
+    """ uss is the memory private to this process, pss splits the shared pages (e.g. a feature table in
+    /dev/shm or the page cache of a memmap) between the processes that map them, shared counts them whole """
     pid = os.getpid()
     p = psutil.Process(pid)
 
     info = p.memory_full_info()
     memory = info.uss / 1024. / 1024. / 1024.
-    print('{} memory used: {} GB, pid: {}'.format(hint, memory, pid))
+    pss = getattr(info, 'pss', 0) / 1024. / 1024. / 1024.
+    shared = getattr(info, 'shared', 0) / 1024. / 1024. / 1024.
+    print('{} memory used: {} GB, pss: {:.3f} GB, shared: {:.3f} GB, pid: {}'.format(hint, memory, pss, shared, pid))
+
+
+def stage_to_shm(path, shm_dir='/dev/shm'):
+    """ Copy a read-only file into shm_dir once per node and return the copy's path.
+    Every rank and DataLoader worker that memory-maps the copy attaches to the same physical pages. The copy is
+    named after the source path, size and mtime, so a rewritten source gets a new copy, and it is made under an
+    exclusive lock and renamed into place, so concurrent ranks wait for the first one instead of copying again.
+    Falls back to path when shm_dir lacks the space.
+    """
+    stat = os.stat(path)
+    key = hashlib.sha1('{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime).encode('utf-8'))
+    shm_path = os.path.join(shm_dir, 'vpgnet_{}_{}'.format(key.hexdigest()[:16], os.path.basename(path)))
+    if os.path.exists(shm_path):
+        return shm_path
+    with open(shm_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(shm_path):
+                if shutil.disk_usage(shm_dir).free < stat.st_size:
+                    print('not enough space in {} for {}, reading it from disk'.format(shm_dir, path))
+                    return path
+                tmp_path = shm_path + '.{}.tmp'.format(os.getpid())
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, shm_path)
+                print('staged {} into {}'.format(path, shm_path))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return shm_path
 
 
 def fn_timer(function):
@@ -34,6 +70,125 @@ def fn_timer(function):
     return function_timer
 
 
+class CudaImgPrefetcher(object):
+    """ Wraps a batch iterable and copies the image tensors of batch i+1 to the GPU on a side stream while
+    batch i is computed. Tensors not pinned by the collater (DataLoader workers can not pin after CUDA is
+    initialized in the parent) are pinned here first. The copy time that ran in the background is reported.
+    """
+
+    def __init__(self, iterable, keys=("img_vec_tokens", "img_vec_tokens_len"), log_interval=1000):
+        self.iterable = iterable
+        self.keys = keys
+        self.log_interval = log_interval
+        self.copy_ms = 0.
+        self.copy_bytes = 0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def preload(self, it, stream):
+        sample = next(it, None)
+        if sample is None or "net_input" not in sample:
+            return sample, None
+        net_input = sample["net_input"]
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        with torch.cuda.stream(stream):
+            start.record(stream)
+            for key in self.keys:
+                tensor = net_input.get(key)
+                if tensor is None or tensor.is_cuda:
+                    continue
+                if not tensor.is_pinned():
+                    tensor = tensor.pin_memory()
+                net_input[key] = tensor.cuda(non_blocking=True)
+                self.copy_bytes += tensor.numel() * tensor.element_size()
+            end.record(stream)
+        return sample, (start, end)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        it = iter(self.iterable)
+        sample, events = self.preload(it, stream)
+        while sample is not None:
+            torch.cuda.current_stream().wait_stream(stream)
+            if events is not None:
+                for key in self.keys:
+                    tensor = sample["net_input"].get(key)
+                    if tensor is not None and tensor.is_cuda:
+                        # the caching allocator must not reuse it while the default stream still reads it
+                        tensor.record_stream(torch.cuda.current_stream())
+            next_sample, next_events = self.preload(it, stream)
+            yield sample
+            if events is not None:
+                events[1].synchronize()
+                self.copy_ms += events[0].elapsed_time(events[1])
+                self.batches += 1
+                if self.batches % self.log_interval == 0:
+                    self.report()
+            sample, events = next_sample, next_events
+        self.report()
+
+    def report(self):
+        if self.batches:
+            print('image prefetch: {} batches, {:.2f} GB copied to the GPU, {:.1f} ms of copies hidden behind '
+                  'compute ({:.2f} ms per batch)'.format(self.batches, self.copy_bytes / 1024. ** 3, self.copy_ms,
+                                                         self.copy_ms / self.batches))
+
+
+class ImgPrefetchEpochBatchIterator(object):
+    """Wraps a fairseq EpochBatchIterator so every epoch yields through CudaImgPrefetcher. The prefetcher reads
+    one batch ahead of the epoch's CountingIterator, so the epoch iterator returned here counts the batches it
+    has handed out itself, and the iteration state saved in checkpoints comes from it. Anything else is read
+    from the wrapped iterator.
+    """
+
+    def __init__(self, epoch_iter):
+        self.epoch_iter = epoch_iter
+        self.itr = None
+
+    def __getattr__(self, name):
+        return getattr(self.epoch_iter, name)
+
+    def __len__(self):
+        return len(self.epoch_iter)
+
+    def next_epoch_itr(self, *args, **kwargs):
+        itr = self.epoch_iter.next_epoch_itr(*args, **kwargs)
+        self.itr = CountingIterator(CudaImgPrefetcher(itr), start=itr.n, total=itr.total)
+        return self.itr
+
+    @property
+    def next_epoch_idx(self):
+        if self.itr is None:
+            return self.epoch_iter.next_epoch_idx
+        return self.epoch_iter.epoch + 1 if self.end_of_epoch() else self.epoch_iter.epoch
+
+    def end_of_epoch(self):
+        if self.itr is None:
+            return self.epoch_iter.end_of_epoch()
+        return not self.itr.has_next()
+
+    @property
+    def iterations_in_epoch(self):
+        if self.itr is None:
+            return self.epoch_iter.iterations_in_epoch
+        return self.itr.n
+
+    def state_dict(self):
+        state = self.epoch_iter.state_dict()
+        if self.itr is not None:
+            if self.end_of_epoch():
+                state["epoch"], state["iterations_in_epoch"] = self.epoch_iter.epoch + 1, 0
+            else:
+                state["epoch"], state["iterations_in_epoch"] = self.epoch_iter.epoch, self.itr.n
+        return state
+
+    def load_state_dict(self, state_dict):
+        self.itr = None
+        self.epoch_iter.load_state_dict(state_dict)
+
+
 def get_masked_softmax(tensor, mask):
     """
     Apply a masked softmax on the last dimension of a tensor.
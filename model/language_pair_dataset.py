@@ -12,6 +12,16 @@ from fairseq.data import FairseqDataset, data_utils
 logger = logging.getLogger(__name__)
 
 
+_img_positions = {}
+
+
+def img_positions(length):
+    """ Cached (1, length) float tensor of the image token positions 1..length """
+    if length not in _img_positions:
+        _img_positions[length] = torch.arange(1, length + 1, dtype=torch.float).unsqueeze(0)
+    return _img_positions[length]
+
+
 def collate(
         samples,
         pad_idx,
@@ -21,6 +31,11 @@ def collate(
         input_feeding=True,
         pad_to_length=None,
         pad_to_multiple=1,
+        img_store=None,
+        pin_memory=False,
+        img_pooling="mean",
+        max_batch_patches=0,
+        src_sizes=None,
 ):
     if len(samples) == 0:
         return {}
@@ -70,9 +85,12 @@ def collate(
         pad_to_length=pad_to_length["source"] if pad_to_length is not None else None,
     )
     # sort by descending source length
-    src_lengths = torch.LongTensor(
-        [s["source"].ne(pad_idx).long().sum() for s in samples]
-    )
+    if src_sizes is not None:
+        src_lengths = torch.from_numpy(src_sizes[id.numpy()].astype(np.int64))
+    else:
+        src_lengths = torch.LongTensor(
+            [s["source"].ne(pad_idx).long().sum() for s in samples]
+        )
     src_lengths, sort_order = src_lengths.sort(descending=True)
     id = id.index_select(0, sort_order)
     src_tokens = src_tokens.index_select(0, sort_order)
@@ -85,10 +103,30 @@ def collate(
     # )
     # sku_vec_tokens = sku_vec_tokens.index_select(0, sort_order)
 
-    img_vec_tokens = torch.Tensor([s["img_vec"] for s in samples])
-    img_vec_tokens = img_vec_tokens.index_select(0, sort_order)
-    img_vec_tokens_len = torch.Tensor([s["img_vec_len"] for s in samples])
-    img_vec_tokens_len = img_vec_tokens_len.index_select(0, sort_order)
+    img_counts = None
+    if img_store is not None and img_pooling == "concat":
+        # the images of every sample one after the other, fewer images per sample when the batch goes over
+        # max_batch_patches
+        img_counts = img_store.image_counts(id.numpy())
+        if max_batch_patches > 0:
+            img_counts = np.minimum(img_counts, max(1, max_batch_patches // (len(samples) * img_store.patch_num)))
+        img_vec_tokens = torch.empty((len(samples), int(img_counts.max()) * img_store.patch_num,
+                                      img_store.feature_size), pin_memory=pin_memory and torch.cuda.is_available())
+        img_store.gather_concat(id.numpy(), img_counts, out=img_vec_tokens.numpy())
+    elif img_store is not None:
+        # one gather from the store straight into the batch tensor, rows already in sorted order
+        img_vec_tokens = torch.empty((len(samples), img_store.patch_num, img_store.feature_size),
+                                     pin_memory=pin_memory and torch.cuda.is_available())
+        img_store.gather(id.numpy(), out=img_vec_tokens.numpy())
+    else:
+        img_vec_tokens = torch.from_numpy(
+            np.stack([samples[i]["img_vec"] for i in sort_order.tolist()]).astype(np.float32, copy=False))
+    # image token positions 1..patch_num, the same for every sample
+    img_vec_tokens_len = img_positions(img_vec_tokens.size(1)).expand(len(samples), -1)
+    if img_counts is not None and (img_counts < img_counts.max()).any():
+        # padded patches get pad_idx, so the encoder padding mask built from these fake tokens covers them
+        img_lens = torch.from_numpy(img_counts * img_store.patch_num).unsqueeze(1)
+        img_vec_tokens_len = img_vec_tokens_len.masked_fill(img_vec_tokens_len > img_lens.float(), pad_idx)
 
     prev_output_tokens = None
     target = None
@@ -217,6 +255,20 @@ class LanguagePairDataset(FairseqDataset):
         tgt_lang_id (int, optional): target language ID, if set, the collated batch
             will contain a field 'tgt_lang_id' which indicates the target language
              of the samples.
+        img_vec (IndexedImgDataset, optional): image features of every example,
+            gathered per batch by the collater.
+        pin_img_memory (bool, optional): collate the image batch into pinned
+            memory for asynchronous copies to the GPU (default: False).
+        img_pooling (str, optional): 'mean' averages the images of a sample
+            into one patch sequence, 'concat' puts their patch sequences one
+            after the other and pads the batch (default: 'mean').
+        max_batch_patches (int, optional): with 'concat', cap the patches of
+            a batch by keeping fewer images per sample (default: 0, no cap).
+        img_tokens (int or np.array, optional): image patch tokens the encoder
+            appends to every source, counted in the size of each example
+            (default: 0).
+        max_source_positions (int, optional): encoder length the source and
+            image tokens are truncated to.
     """
 
     def __init__(
@@ -242,7 +294,12 @@ class LanguagePairDataset(FairseqDataset):
             tgt_lang_id=None,
             pad_to_multiple=1,
             img_vec=None,
-            sku_vec=None
+            sku_vec=None,
+            pin_img_memory=False,
+            img_tokens=0,
+            max_source_positions=None,
+            img_pooling="mean",
+            max_batch_patches=0,
     ):
         if tgt_dict is not None:
             assert src_dict.pad() == tgt_dict.pad()
@@ -255,11 +312,18 @@ class LanguagePairDataset(FairseqDataset):
         self.src = src
         self.tgt = tgt
         self.src_sizes = np.array(src_sizes)
+        # unpadded source lengths for the collater, unknown when __getitem__ may add or remove a token
+        self.collate_src_sizes = (
+            self.src_sizes if not (append_bos or remove_eos_from_source) else None
+        )
         self.tgt_sizes = np.array(tgt_sizes) if tgt_sizes is not None else None
+        self.img_tokens = img_tokens
+        self.max_source_positions = max_source_positions
+        self.encoder_sizes = self.get_encoder_sizes(self.src_sizes)
         self.sizes = (
-            np.vstack((self.src_sizes, self.tgt_sizes)).T
+            np.vstack((self.encoder_sizes, self.tgt_sizes)).T
             if self.tgt_sizes is not None
-            else self.src_sizes
+            else self.encoder_sizes
         )
         self.src_dict = src_dict
         self.tgt_dict = tgt_dict
@@ -273,6 +337,9 @@ class LanguagePairDataset(FairseqDataset):
 
         """ img vec """
         self.img_vec = img_vec
+        self.pin_img_memory = pin_img_memory
+        self.img_pooling = img_pooling
+        self.max_batch_patches = max_batch_patches
         """ sku vec (segment vec) """
         self.sku_vec = sku_vec
 
@@ -296,6 +363,7 @@ class LanguagePairDataset(FairseqDataset):
                 left_pad=self.left_pad_source,
             )
             self.src_sizes = self.src.sizes
+            self.encoder_sizes = self.get_encoder_sizes(self.src_sizes)
             logger.info("bucketing source lengths: {}".format(list(self.src.buckets)))
             if self.tgt is not None:
                 self.tgt = BucketPadLengthDataset(
@@ -328,6 +396,18 @@ class LanguagePairDataset(FairseqDataset):
             self.buckets = None
         self.pad_to_multiple = pad_to_multiple
 
+    def get_encoder_sizes(self, src_sizes):
+        """Encoder lengths: the source plus the appended image tokens, truncated
+        to max_source_positions like in the encoder. A source that is too long
+        by itself keeps its own length so it is still filtered out."""
+        if np.all(np.asarray(self.img_tokens) == 0):
+            return src_sizes
+        sizes = src_sizes + self.img_tokens
+        if self.max_source_positions is not None:
+            sizes = np.where(src_sizes <= self.max_source_positions,
+                             np.minimum(sizes, self.max_source_positions), src_sizes)
+        return sizes
+
     def get_batch_shapes(self):
         return self.buckets
 
@@ -358,14 +438,13 @@ class LanguagePairDataset(FairseqDataset):
                 src_item = self.src[index][:-1]
 
 
-        img_vec_item = self.img_vec[index]
+        # features of an image store are gathered for the whole batch in the collater
+        img_vec_item = None if self.img_store is not None else self.img_vec[index]
 
         # fake_img_vec_item = np.random.rand(48, 2048)
         # img_vec_item = np.concatenate((np.expand_dims(img_vec_item, axis=0), fake_img_vec_item), axis=-2)
         # img_vec_item = np.random.rand(196, 1024)
 
-        # img_vec_item_len = self.img_vec.num_tokens(index)
-        img_vec_item_len = [idx + 1 for idx in range(np.shape(img_vec_item)[0])]
         # sku_vec_item = self.sku_vec[index]
         sku_vec_item = None
         example = {
@@ -373,7 +452,6 @@ class LanguagePairDataset(FairseqDataset):
             "source": src_item,
             "target": tgt_item,
             "img_vec": img_vec_item,
-            "img_vec_len": img_vec_item_len,
             "sku_vec": sku_vec_item
         }
         if self.align_dataset is not None:
@@ -385,6 +463,10 @@ class LanguagePairDataset(FairseqDataset):
     def __len__(self):
         return len(self.src)
 
+    @property
+    def img_store(self):
+        return self.img_vec if hasattr(self.img_vec, "gather") else None
+
     def collater(self, samples, pad_to_length=None):
         """Merge a list of samples to form a mini-batch.
 
@@ -430,6 +512,11 @@ class LanguagePairDataset(FairseqDataset):
             input_feeding=self.input_feeding,
             pad_to_length=pad_to_length,
             pad_to_multiple=self.pad_to_multiple,
+            img_store=self.img_store,
+            pin_memory=self.pin_img_memory,
+            img_pooling=self.img_pooling,
+            max_batch_patches=self.max_batch_patches,
+            src_sizes=self.collate_src_sizes,
         )
         if self.src_lang_id is not None or self.tgt_lang_id is not None:
             src_tokens = res["net_input"]["src_tokens"]
@@ -448,14 +535,14 @@ class LanguagePairDataset(FairseqDataset):
         """Return the number of tokens in a sample. This value is used to
         enforce ``--max-tokens`` during batching."""
         return max(
-            self.src_sizes[index],
+            self.encoder_sizes[index],
             self.tgt_sizes[index] if self.tgt_sizes is not None else 0,
         )
 
     def num_tokens_vec(self, indices):
         """Return the number of tokens for a set of positions defined by indices.
         This value is used to enforce ``--max-tokens`` during batching."""
-        sizes = self.src_sizes[indices]
+        sizes = self.encoder_sizes[indices]
         if self.tgt_sizes is not None:
             sizes = np.maximum(sizes, self.tgt_sizes[indices])
         return sizes
@@ -464,7 +551,7 @@ class LanguagePairDataset(FairseqDataset):
         """Return an example's size as a float or tuple. This value is used when
         filtering a dataset with ``--max-positions``."""
         return (
-            self.src_sizes[index],
+            self.encoder_sizes[index],
             self.tgt_sizes[index] if self.tgt_sizes is not None else 0,
         )
 
@@ -479,7 +566,10 @@ class LanguagePairDataset(FairseqDataset):
             # sort by target length, then source length
             if self.tgt_sizes is not None:
                 indices = indices[np.argsort(self.tgt_sizes[indices], kind="mergesort")]
-            return indices[np.argsort(self.src_sizes[indices], kind="mergesort")]
+            # with a per example number of image tokens (--img-pooling concat) sort by the
+            # encoder length, so 1-image lines are not padded to the patches of N-image lines
+            src_sizes = self.encoder_sizes if np.ndim(self.img_tokens) > 0 else self.src_sizes
+            return indices[np.argsort(src_sizes[indices], kind="mergesort")]
         else:
             # sort by bucketed_num_tokens, which is:
             #   max(padded_src_len, padded_tgt_len)
@@ -489,16 +579,22 @@ class LanguagePairDataset(FairseqDataset):
 
     @property
     def supports_prefetch(self):
-        return getattr(self.src, "supports_prefetch", False) and (
-                getattr(self.tgt, "supports_prefetch", False) or self.tgt is None
+        return getattr(self.img_store, "supports_prefetch", False) or (
+                getattr(self.src, "supports_prefetch", False) and (
+                    getattr(self.tgt, "supports_prefetch", False) or self.tgt is None
+                )
         )
 
     def prefetch(self, indices):
-        self.src.prefetch(indices)
-        if self.tgt is not None:
+        if getattr(self.src, "supports_prefetch", False):
+            self.src.prefetch(indices)
+        if self.tgt is not None and getattr(self.tgt, "supports_prefetch", False):
             self.tgt.prefetch(indices)
-        if self.align_dataset is not None:
+        if self.align_dataset is not None and getattr(self.align_dataset, "supports_prefetch", False):
             self.align_dataset.prefetch(indices)
+        if getattr(self.img_store, "supports_prefetch", False):
+            # image rows are read ahead in the background, in the order of the epoch's batches
+            self.img_store.prefetch(indices)
 
     def filter_indices_by_size(self, indices, max_sizes):
         """Filter a list of sample indices. Remove those that are longer
@@ -514,7 +610,7 @@ class LanguagePairDataset(FairseqDataset):
             list: list of removed indices
         """
         return data_utils.filter_paired_dataset_indices_by_size(
-            self.src_sizes,
+            self.encoder_sizes,
             self.tgt_sizes,
             indices,
             max_sizes,
@@ -6,10 +6,12 @@
 import itertools
 import json
 import logging
+import mmap
 import os
-import sys
+import threading
 from argparse import Namespace
-from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from .bert_dictionary import BertDictionary
 from fairseq.data.dictionary import Dictionary
 import numpy as np
@@ -26,12 +28,19 @@ from fairseq.data import (
     FairseqDataset
 )
 from .language_pair_dataset import LanguagePairDataset
-from .custom_util import fn_timer, show_memory_info
+from .custom_util import fn_timer, show_memory_info, stage_to_shm, ImgPrefetchEpochBatchIterator
 from fairseq.tasks import LegacyFairseqTask, register_task
 import gc
+import psutil
+import torch
+# --user-dir model puts the repo root on sys.path
+from img_feature_format import ImgIndex, index_exists, storage_name, to_float32, FeatureCodec, codec_path
 
 EVAL_BLEU_ORDER = 4
 
+# task types whose encoder appends the image patches to the source tokens (TransformerEncoder.forward)
+IMG_TOKEN_TASK_TYPES = ('new_vpg', 'new_single_vpg', 'vpg_none', 'new_tpg')
+
 logger = logging.getLogger(__name__)
 
 
@@ -60,7 +69,8 @@ def load_langpair_dataset(
         img2vec_path=None,
         sku2vec_path=None,
         sku2vec_dict=None,
-        args=None
+        args=None,
+        img_stores=None,
 ):
     def split_exists(split, src, tgt, lang, data_path):
         filename = os.path.join(data_path, "{}.{}-{}.{}".format(split, src, tgt, lang))
@@ -168,7 +178,7 @@ def load_langpair_dataset(
 
     tgt_dataset_sizes = tgt_dataset.sizes if tgt_dataset is not None else None
 
-    if args.is_multi_files:
+    if args.is_multi_files and not getattr(args, "img_manifest", None):
         if split in ('valid', 'test'):
             img2vec_path = '/'.join(
                 data_path.split('/')[:-2] + ['bpe_mg_batch/image_patch_vectors_' + split + '.npy'])
@@ -180,8 +190,20 @@ def load_langpair_dataset(
             img2ids_path = '/'.join(
                 data_path.split('/')[:-2] + ['bpe_mg_batch/part_' + str(part_num) + '.img2ids'])
 
-    img_vec = IndexedImgDataset.instance()
-    img_vec.read_data(img2vec_path=img2vec_path, img2ids_path=img2ids_path)
+    if img_stores is not None:
+        img_vec = img_stores.get(split, img2vec_path=img2vec_path, img2ids_path=img2ids_path)
+    else:
+        img_vec = IndexedImgDataset(img2vec_path=img2vec_path, img2ids_path=img2ids_path,
+                                    shm_dir=getattr(args, "img_shm_dir", None),
+                                    patch_embed_size=getattr(args, "patch_embed_size", None))
+
+    img_pooling = getattr(args, "img_pooling", "mean")
+    if img_pooling == "concat" and args.task_type not in IMG_TOKEN_TASK_TYPES:
+        raise ValueError("--img-pooling concat needs a task type whose encoder appends the image tokens: {}".format(
+            ", ".join(IMG_TOKEN_TASK_TYPES)))
+    img_tokens = 0
+    if args.task_type in IMG_TOKEN_TASK_TYPES:
+        img_tokens = img_vec.patch_num if img_pooling == "mean" else img_vec.image_counts() * img_vec.patch_num
 
     return LanguagePairDataset(
         src_dataset,
@@ -198,7 +220,11 @@ def load_langpair_dataset(
         shuffle=shuffle,
         pad_to_multiple=pad_to_multiple,
         img_vec=img_vec,
-        sku_vec=sku_vec
+        sku_vec=sku_vec,
+        img_tokens=img_tokens,
+        max_source_positions=max_source_positions,
+        img_pooling=img_pooling,
+        max_batch_patches=getattr(args, "max_batch_patches", 0),
     )
 
 
@@ -328,12 +354,54 @@ class MatchgoTask(LegacyFairseqTask):
             type=float,
             default=1.0,
         )
+        parser.add_argument('--img-store-budget-gb', type=float, default=0,
+                            help='memory budget of the loaded image stores (train/valid/test), least recently '
+                                 'used stores are released beyond it; 0 means no limit')
+        parser.add_argument('--img-shm-dir', type=str, default=None,
+                            help='copy the image feature matrices into this shared-memory dir (e.g. /dev/shm) once '
+                                 'per node, all ranks and data loader workers map the same copy; the copies are '
+                                 'kept for later runs, remove them by hand')
+        parser.add_argument('--img-manifest', type=str, default=None,
+                            help='json shard manifest written by data_process/make_shard_manifest.py, gives the data '
+                                 'dir, img2ids and feature file of every train/valid/test shard; the next train '
+                                 'shard is loaded in the background during the current epoch')
+        parser.add_argument('--img-pooling', choices=['mean', 'concat'], default='mean',
+                            help='mean: the images of a sku listing several are averaged into one patch sequence; '
+                                 'concat: their patch sequences follow each other and shorter ones are padded '
+                                 '(only for task types appending the image tokens in the encoder)')
+        parser.add_argument('--max-batch-patches', type=int, default=0,
+                            help='with --img-pooling concat, cap the patches of a batch by keeping fewer images per '
+                                 'sku; 0 means no cap')
+        parser.add_argument('--img-cuda-prefetch', action='store_true', default=False,
+                            help='collate image batches into pinned memory and copy the next batch to the GPU '
+                                 'on a side stream while the current one is computed')
 
     def __init__(self, args, src_dict, tgt_dict, sku2vec_dict):
         super().__init__(args)
         self.src_dict = src_dict
         self.tgt_dict = tgt_dict
         self.sku2vec_dict = sku2vec_dict
+        self.img_stores = ImgStoreRegistry(max_gb=getattr(args, "img_store_budget_gb", 0),
+                                           shm_dir=getattr(args, "img_shm_dir", None),
+                                           patch_embed_size=getattr(args, "patch_embed_size", None))
+        self.manifest = None
+        if getattr(args, "img_manifest", None):
+            with open(args.img_manifest, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    def manifest_shards(self, split):
+        if self.manifest is None:
+            return None
+        name = "train" if split == getattr(self.args, "train_subset", None) else split
+        return self.manifest.get(name)
+
+    def has_sharded_data(self, split):
+        """ fairseq only reloads the train set every epoch for sharded data, i.e. several --data dirs; a manifest
+        with several train shards is sharded as well, even with a single --data dir """
+        shards = self.manifest_shards(split)
+        if shards is not None and len(shards) > 1:
+            return True
+        return super().has_sharded_data(split)
 
     @classmethod
     def load_dictionary(cls, filename, bertdict=False):
@@ -402,6 +470,14 @@ class MatchgoTask(LegacyFairseqTask):
             paths = paths[:1]
         data_path = paths[(epoch - 1) % len(paths)]
 
+        img2ids_path = self.args.img2ids_path + '/' + split + '.img2ids' if self.args.img2ids_path else None
+        img2vec_path = self.args.img2vec_path
+        shards = self.manifest_shards(split)
+        if shards:
+            shard = shards[(epoch - 1) % len(shards)]
+            data_path, img2ids_path, img2vec_path = shard["data"], shard["img2ids"], shard["img2vec"]
+            logger.info("{} shard {} of the manifest: {}".format(split, (epoch - 1) % len(shards), shard))
+
         # infer langcode
         src, tgt = self.args.source_lang, self.args.target_lang
 
@@ -424,13 +500,32 @@ class MatchgoTask(LegacyFairseqTask):
             num_buckets=self.args.num_batch_buckets,
             shuffle=(split != "test"),
             pad_to_multiple=self.args.required_seq_len_multiple,
-            img2ids_path=self.args.img2ids_path + '/' + split + '.img2ids',
-            img2vec_path=self.args.img2vec_path,
+            img2ids_path=img2ids_path,
+            img2vec_path=img2vec_path,
             sku2vec_path=self.args.sku2vec_path + '/' + split + '.sku2vec',
             sku2vec_dict=self.sku2vec_dict,
             args=self.args,
+            img_stores=self.img_stores,
         )
 
+        if shards:
+            if shard.get("examples") is not None and len(self.datasets[split].img_vec) != shard["examples"]:
+                raise ValueError("{} has {} img2ids lines, the manifest says {}".format(
+                    img2ids_path, len(self.datasets[split].img_vec), shard["examples"]))
+            if len(shards) > 1:
+                next_shard = shards[epoch % len(shards)]
+                self.img_stores.prefetch(split, img2vec_path=next_shard["img2vec"],
+                                         img2ids_path=next_shard["img2ids"])
+
+    def get_batch_iterator(self, dataset, *args, **kwargs):
+        epoch_iter = super().get_batch_iterator(dataset, *args, **kwargs)
+        if getattr(self.args, "img_cuda_prefetch", False) and torch.cuda.is_available() \
+                and isinstance(dataset, LanguagePairDataset) and dataset.img_store is not None:
+            # worker processes can not pin memory once CUDA is initialized, the prefetcher pins for them
+            dataset.pin_img_memory = kwargs.get("num_workers", 0) == 0
+            return ImgPrefetchEpochBatchIterator(epoch_iter)
+        return epoch_iter
+
     def build_dataset_for_inference(self, src_tokens, src_lengths, constraints=None):
         return LanguagePairDataset(
             src_tokens,
@@ -567,126 +662,314 @@ class MatchgoTask(LegacyFairseqTask):
 
 
 class IndexedImgDataset(FairseqDataset):
-    """Takes img ids and img vector files as input and binarizes it in memory at instantiation.
-    Original lines are also kept in memory"""
-
-    ins_ = None
+    """Takes img ids and img vector files as input. The img vector file is memory-mapped and stays read-only,
+    it holds one row per unique sku and every line only keeps an int32 index into it (example2row).
+    Lines listing several images point past the last row, to a shared CSR table of the distinct img id
+    lists (multi_offsets, multi_indices), and are averaged at gather time.
+    The matrix can be stored in float16 or bfloat16 (data_process/feature_dtype.py), rows are upcast to float32
+    per batch so only the gathered batch ever exists in float32.
+    With shm_dir the matrix is mapped from a node-wide copy in shared memory (see custom_util.stage_to_shm).
+    A matrix compressed by data_process/feature_codec.py holds PCA or PQ codes and is decoded per batch, PCA codes
+    are returned as they are when patch_embed_size is the number of components."""
+
+    def __init__(self, img2vec_path=None, img2ids_path=None, shm_dir=None, patch_embed_size=None):
+        self.img2vec_path = img2vec_path
+        self.img2ids_path = img2ids_path
+        self.shm_dir = shm_dir
+        self.patch_embed_size = patch_embed_size
+        self.feature_path = None
+        self.image_feature = None
+        self.codec = None
+        self.emit_codes = False
+        self.prefetch_thread = None
+        self.prefetch_stop = None
+        self.row_num = 0
+        self.example2row = np.zeros(0, dtype=np.int32)
+        self.multi_offsets = np.zeros(1, dtype=np.int64)
+        self.multi_indices = np.zeros(0, dtype=np.int64)
+        self.sizes = np.zeros(0, dtype=np.int64)
+
+        self.size = 0
+        if img2vec_path is not None:
+            self.read_data(img2vec_path, img2ids_path)
 
-    @classmethod
-    def instance(cls):
-        cls.ins_ = cls.ins_ if cls.ins_ else IndexedImgDataset()
-        return cls.ins_
+    @property
+    def nbytes(self):
+        """ Memory held by this store, the memory-mapped feature matrix counts with its full size: training reads
+        all of it every epoch, so its pages end up resident until the store is released """
+        if self.image_feature is None:
+            return 0
+        return (self.image_feature.nbytes + self.example2row.nbytes + self.multi_offsets.nbytes +
+                self.multi_indices.nbytes)
+
+    def release(self):
+        """ Drop the loaded arrays, they are read again from the same files on the next access """
+        self.stop_prefetch()
+        self.image_feature = None
+        self.example2row = np.zeros(0, dtype=np.int32)
+        self.multi_offsets = np.zeros(1, dtype=np.int64)
+        self.multi_indices = np.zeros(0, dtype=np.int64)
+
+    def warm(self, chunk_size=64 * 1024 ** 2):
+        """ Read the feature file once so its pages are in the page cache before training touches them """
+        buf = bytearray(chunk_size)
+        with open(self.feature_path, "rb", buffering=0) as f:
+            while f.readinto(buf):
+                pass
+
+    def ensure_loaded(self):
+        """ Reload a released store, the accessors the collater uses (patch_num, feature_size, image_counts,
+        gather, gather_concat) call this first """
+        if self.image_feature is None and self.img2vec_path is not None:
+            self.read_data(self.img2vec_path, self.img2ids_path)
 
-    def __init__(self):
-        self.tokens_list = []
-        self.sizes = []
-        self.lines = []
+    @staticmethod
+    def read_img2ids(img2ids_path):
+        """ Parse an img2ids file into CSR (offsets, indices) arrays """
+        with open(img2ids_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        indices = np.fromstring(text, dtype=np.int64, sep=' ')
+        line_num = text.count('\n') + (0 if not text or text.endswith('\n') else 1)
+        if len(indices) == line_num:
+            counts = np.ones(line_num, dtype=np.int64)
+        else:
+            counts = np.fromiter((len(line.split()) for line in text.splitlines()), dtype=np.int64, count=line_num)
+        offsets = np.zeros(line_num + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, indices
 
-        self.size = len(self.tokens_list)
+    @staticmethod
+    def build_example2row(offsets, indices, row_num):
+        """ Map every line to its feature row, or to row_num + g for the g-th distinct multi img id list
+        :returns: example2row, multi_offsets, multi_indices
+        """
+        example2row = np.array(indices[offsets[:-1]])
+        groups = dict()
+        multi_offsets = [0]
+        multi_indices = []
+        for i in np.nonzero(np.diff(offsets) > 1)[0]:
+            key = tuple(indices[offsets[i]:offsets[i + 1]].tolist())
+            if key not in groups:
+                groups[key] = len(groups)
+                multi_indices.extend(key)
+                multi_offsets.append(len(multi_indices))
+            example2row[i] = row_num + groups[key]
+        if row_num + len(groups) < np.iinfo(np.int32).max:
+            example2row = example2row.astype(np.int32)
+        return example2row, np.array(multi_offsets, dtype=np.int64), np.array(multi_indices, dtype=np.int64)
 
     @fn_timer
     def read_data(self, img2vec_path, img2ids_path):
-        # way-1
-        # self.tokens_list = []
-        # self.sizes = []
-        # self.lines = []
+        # a running readahead would map the rows of the new files into the old feature file
+        self.stop_prefetch()
+        self.img2vec_path = img2vec_path
+        self.img2ids_path = img2ids_path
+        show_memory_info("before load numpy image_feature")
+        # pages are read on access and shared through the page cache, or through shared memory with shm_dir
+        self.feature_path = stage_to_shm(img2vec_path, self.shm_dir) if self.shm_dir else img2vec_path
+        self.image_feature = np.load(self.feature_path, mmap_mode='r')
+        self.row_num = len(self.image_feature)
+        show_memory_info("after load numpy image_feature")
 
-        # way-2
-        # self.tokens_list[:] = []
-        # self.sizes[:] = []
-        # self.lines[:] = []
+        self.codec = None
+        self.emit_codes = False
+        if os.path.exists(codec_path(img2vec_path)):
+            self.codec = FeatureCodec.load(codec_path(img2vec_path))
+            self.emit_codes = self.codec.kind == 'pca' and self.patch_embed_size == self.codec.code_dim
+            print('################{} codec, {} codes per patch, {}'.format(
+                self.codec.kind, self.codec.code_dim,
+                'fed as they are' if self.emit_codes else 'decoded to {} dims'.format(self.codec.out_dim)))
 
-        # way-3
-        # del self.tokens_list
-        # del self.sizes
-        # del self.lines
+        print('################img2ids_path', img2ids_path)
+        print('################img2vec_path: {}, shape is {}, storage dtype: {}'.format(
+            img2vec_path, np.shape(self.image_feature), storage_name(self.image_feature.dtype)))
 
-        # way-4
-        show_memory_info("before gc torch image_feature ")
-        self.image_feature = []
+        if index_exists(img2ids_path):
+            # binary img2ids written by extract_patch_vector.py or data_process/img_index.py
+            img_index = ImgIndex(img2ids_path)
+            offsets, indices = img_index.offsets, img_index.data
+        else:
+            offsets, indices = self.read_img2ids(img2ids_path)
+        self.example2row, self.multi_offsets, self.multi_indices = self.build_example2row(
+            offsets, indices, self.row_num)
+        self.sizes = np.ones(len(self.example2row), dtype=np.int64)
+        show_memory_info("after load img ids")
 
-        print("[1]image_feature ref num: {}".format(sys.getrefcount(self.image_feature) - 1))
-        self.tokens_list = []
-        self.sizes = []
-        self.lines = []
+        self.size = len(self.example2row)
+        print('self.size: {}, distinct image entries used: {}, distinct multi img lists: {}'.format(
+            self.size, len(np.unique(self.example2row)), len(self.multi_offsets) - 1))
 
-        print("[2]image_feature ref num: {}".format(sys.getrefcount(self.image_feature) - 1))
-        show_memory_info("after gc torch image_feature ")
+    @property
+    def patch_num(self):
+        self.ensure_loaded()
+        return self.image_feature.shape[1]
 
-        show_memory_info("before load numpy image_feature")
-        self.image_feature = np.load(img2vec_path)
-        print("[3]image_feature ref num: {}".format(sys.getrefcount(self.image_feature) - 1))
-        show_memory_info("after load numpy image_feature")
+    @property
+    def feature_size(self):
+        self.ensure_loaded()
+        if self.codec is None or self.emit_codes:
+            return self.image_feature.shape[-1]
+        return self.codec.out_dim
+
+    def take_rows(self, rows, out=None):
+        """ float32 features of feature matrix rows, decoded when the matrix holds codes, written into out
+        when it is given """
+        if out is not None and self.codec is None and self.image_feature.dtype == out.dtype:
+            # float32 rows are copied from the memmap straight into out; with the default mode='raise' numpy
+            # gathers into a temporary first, rows come from example2row/multi_indices and are always valid
+            return np.take(self.image_feature, rows, axis=0, out=out, mode='clip')
+        vecs = self.image_feature[rows]
+        if self.codec is None or self.emit_codes:
+            vecs = to_float32(vecs)
+        else:
+            vecs = self.codec.decode(vecs)
+        if out is None:
+            return vecs
+        out[...] = vecs
+        return out
+
+    def image_counts(self, ids=None):
+        """ Number of images listed by every line of ids (by every line if ids is None) """
+        self.ensure_loaded()
+        rows = self.example2row if ids is None else self.example2row[np.asarray(ids, dtype=np.int64)]
+        counts = np.ones(len(rows), dtype=np.int64)
+        multi = rows >= self.row_num
+        groups = rows[multi].astype(np.int64) - self.row_num
+        counts[multi] = self.multi_offsets[groups + 1] - self.multi_offsets[groups]
+        return counts
+
+    def gather_concat(self, ids, counts, out=None):
+        """Return the image features of the lines in ids with their images one after the other, shape
+        (len(ids), max(counts) * patch_num, feature_size). Line i keeps its first counts[i] images, the patches
+        after them are zeros. A batch of single image lines costs the same as gather.
 
-        print("[tokens_list] obj id: {}".format(id(self.tokens_list)))
-        print("[sizes] obj id: {}".format(id(self.sizes)))
-        print("[lines] obj id: {}".format(id(self.lines)))
-        print("[image_feature] obj id: {}".format(id(self.image_feature)))
-        print('################img2ids_path', img2ids_path)
-        print('################img2vec_path: {}, shape is {}'.format(img2vec_path, np.shape(self.image_feature)))
+        Args:
+            ids (np.array): line indices
+            counts (np.array): images to keep for every line, at most image_counts(ids)
+            out (np.array, optional): preallocated float32 output
+        """
+        self.ensure_loaded()
+        rows = self.example2row[np.asarray(ids, dtype=np.int64)].astype(np.int64)
+        patch_num, max_count = self.patch_num, int(counts.max())
+        if out is None:
+            out = np.empty((len(rows), max_count * patch_num, self.feature_size), dtype=np.float32)
+        single = rows < self.row_num
+        if max_count == 1 and single.all():
+            return self.take_rows(rows, out=out)
+        starts = np.where(single, 0, self.multi_offsets[np.where(single, 0, rows - self.row_num)])
+        for j in range(max_count):
+            slot = out[:, j * patch_num: (j + 1) * patch_num]
+            used = counts > j
+            img_rows = np.where(single, rows, self.multi_indices[np.minimum(starts + j, len(self.multi_indices) - 1)])
+            slot[used] = self.take_rows(img_rows[used])
+            slot[~used] = 0
+        return out
+
+    def gather(self, ids, out=None):
+        """Return the (averaged) image features of the lines in ids, shape (len(ids), patch_num, feature_size).
 
-        show_memory_info("before load torch image_feature ")
-        with open(img2ids_path, "r", encoding="utf-8") as f:
-            input_lines = f.readlines()
-            max_len = max([len(line.strip().split()) for line in input_lines])
-            print('max_len', max_len)
-
-            for line in input_lines:
-                self.lines.append(line.strip())
-                id_list = [int(seg) for seg in line.strip().split()]
-                img = None
-                for idx in id_list:
-                    if img is None:
-                        img = self.image_feature[idx]
-                    else:
-                        img += self.image_feature[idx]
-                    # cur_token.append(image_feature[idx])
-                img /= len(id_list)
-                # for _ in range(max_len - len(id_list)):
-                # cur_token.append(np.zeros(feature_dim, dtype=np.float32))
-                # self.tokens_list.append(cur_token)
-                self.tokens_list.append(img)
-                # self.sizes.append(len(id_list))
-                self.sizes.append(1)
-        show_memory_info("after load torch image_feature ")
-        print("[4]image_feature ref num: {}".format(sys.getrefcount(self.image_feature) - 1))
-
-        self.size = len(self.tokens_list)
-        print('self.size', self.size)
-
-    # def read_data(self, img2ids_path, img2vec_path):
-    #     sku_path = str(img2ids_path).replace('img2ids', 'sku')
-    #     image_feature_dir = "/".join(str(img2vec_path).split('/')[:-1] + ['image_patch_vectors'])
-    #     print('################sku_path', img2ids_path)
-    #     print('################image_feature_dir', img2vec_path)
-    #
-    #     with open(sku_path, "r", encoding="utf-8") as f:
-    #         input_lines = f.readlines()
-    #         for line in input_lines:
-    #             self.lines.append(line.strip())
-    #
-    #             img = np.load(image_feature_dir + '/' + line.strip() + '.npy').squeeze()
-    #
-    #             self.tokens_list.append(img)
-    #
-    #             self.sizes.append(1)
-    #     self.sizes = np.array(self.sizes)
+        Args:
+            ids (np.array): line indices
+            out (np.array, optional): preallocated float32 output, e.g. the numpy view of a batch tensor
+        """
+        self.ensure_loaded()
+        rows = self.example2row[np.asarray(ids, dtype=np.int64)]
+        if out is None:
+            out = np.empty((len(rows),) + self.image_feature.shape[1:-1] + (self.feature_size,), dtype=np.float32)
+        single = rows < self.row_num
+        if single.all():
+            return self.take_rows(rows, out=out)
+        out[single] = self.take_rows(rows[single])
+
+        groups = rows[~single].astype(np.int64) - self.row_num
+        starts = self.multi_offsets[groups]
+        counts = self.multi_offsets[groups + 1] - starts
+        seg_starts = np.cumsum(counts) - counts
+        positions = np.arange(counts.sum()) - np.repeat(seg_starts, counts) + np.repeat(starts, counts)
+        multi_rows = self.take_rows(self.multi_indices[positions])
+        averaged = np.add.reduceat(multi_rows, seg_starts, axis=0)
+        averaged /= counts.reshape((-1,) + (1,) * (averaged.ndim - 1))
+        out[~single] = averaged
+        return out
+
+    def feature_rows(self, ids):
+        """ Feature matrix rows read for the lines in ids, the rows of every image of multi image lines """
+        rows = self.example2row[np.asarray(ids, dtype=np.int64)].astype(np.int64)
+        single = rows < self.row_num
+        groups = rows[~single] - self.row_num
+        starts = self.multi_offsets[groups]
+        counts = self.multi_offsets[groups + 1] - starts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        return np.concatenate([rows[single], self.multi_indices[positions]])
+
+    @property
+    def supports_prefetch(self):
+        return True
+
+    def prefetch(self, indices, max_gb=None):
+        """Start reading ahead the feature rows of indices, in their (batch) order, in a background thread.
+        fairseq calls this with the indices of the whole epoch, so the readahead stops after max_gb, half of the
+        available memory by default, not to evict the pages it warmed first. A new call stops the previous one.
+        """
+        self.ensure_loaded()
+        self.stop_prefetch()
+        if not isinstance(self.image_feature, np.memmap) or len(indices) == 0:
+            return
+        max_bytes = psutil.virtual_memory().available // 2 if max_gb is None else int(max_gb * 1024 ** 3)
+        self.prefetch_stop = threading.Event()
+        self.prefetch_thread = threading.Thread(target=self.readahead, daemon=True,
+                                                args=(np.asarray(indices), self.prefetch_stop, max_bytes))
+        self.prefetch_thread.start()
+
+    def stop_prefetch(self):
+        if self.prefetch_thread is not None:
+            self.prefetch_stop.set()
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+    def readahead(self, indices, stop, max_bytes, chunk_size=4096):
+        """ madvise(WILLNEED) the sorted, coalesced row ranges of every chunk of indices, so the kernel reads
+        them asynchronously with large sequential requests before the data loader asks for them """
+        row_bytes = int(np.prod(self.image_feature.shape[1:])) * self.image_feature.itemsize
+        offset = self.image_feature.offset
+        advised = 0
+        with open(self.feature_path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for start in range(0, len(indices), chunk_size):
+                    if stop.is_set() or advised >= max_bytes:
+                        break
+                    rows = np.unique(self.feature_rows(indices[start: start + chunk_size]))
+                    for run in np.split(rows, np.nonzero(np.diff(rows) != 1)[0] + 1):
+                        begin = offset + int(run[0]) * row_bytes
+                        end = offset + (int(run[-1]) + 1) * row_bytes
+                        aligned = begin - begin % mmap.PAGESIZE
+                        if hasattr(mmap, "MADV_WILLNEED"):
+                            mapped.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+                        else:
+                            mapped[aligned: end: mmap.PAGESIZE]
+                        advised += end - begin
+            finally:
+                mapped.close()
 
     def check_index(self, i):
         if i < 0 or i >= self.size:
             print("i: ", i)
             print('self.size', self.size)
-            print('self.tokens_list', len(self.tokens_list))
             raise IndexError("index out of range")
 
-    @lru_cache(maxsize=8)
     def __getitem__(self, i):
         self.check_index(i)
-        return self.tokens_list[i]
+        return self.gather([i])[0]
 
     def get_original_text(self, i):
         self.check_index(i)
-        return self.lines[i]
+        self.ensure_loaded()
+        row = int(self.example2row[i])
+        if row < self.row_num:
+            return str(row)
+        group = row - self.row_num
+        return " ".join(str(idx) for idx in self.multi_indices[self.multi_offsets[group]:self.multi_offsets[group + 1]])
 
     def __del__(self):
         pass
@@ -703,3 +986,75 @@ class IndexedImgDataset(FairseqDataset):
     @staticmethod
     def exists(path):
         return PathManager.exists(path)
+
+
+class ImgStoreRegistry(object):
+    """Named image stores, one IndexedImgDataset per split (or shard), so train and valid features coexist
+    instead of overwriting each other. Loading a name again with the same files reuses its store, loading it
+    with other files (the next train shard) replaces it. Beyond max_gb the least recently used stores are
+    released; a released store reloads itself from its files if it is used again."""
+
+    def __init__(self, max_gb=0, shm_dir=None, patch_embed_size=None):
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.shm_dir = shm_dir
+        self.patch_embed_size = patch_embed_size
+        self.stores = OrderedDict()
+        self.prefetching = dict()
+        self.executor = None
+
+    def load_store(self, img2vec_path, img2ids_path, warm=False):
+        store = IndexedImgDataset(img2vec_path=img2vec_path, img2ids_path=img2ids_path, shm_dir=self.shm_dir,
+                                  patch_embed_size=self.patch_embed_size)
+        if warm:
+            store.warm()
+        return store
+
+    def prefetch(self, name, img2vec_path, img2ids_path):
+        """ Load the store that will replace name (the next train shard) in a background thread, the next
+        get() with the same files picks it up instead of loading it """
+        key = (name, img2vec_path, img2ids_path)
+        store = self.stores.get(name)
+        if key in self.prefetching or (store is not None and (store.img2vec_path, store.img2ids_path) ==
+                                       (img2vec_path, img2ids_path)):
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        logger.info("prefetch image store {}: {}".format(name, img2vec_path))
+        self.prefetching[key] = self.executor.submit(self.load_store, img2vec_path, img2ids_path, True)
+
+    def get(self, name, img2vec_path, img2ids_path):
+        store = self.stores.get(name)
+        if store is not None and (store.img2vec_path, store.img2ids_path) == (img2vec_path, img2ids_path):
+            self.stores.move_to_end(name)
+            store.ensure_loaded()
+        else:
+            if store is not None:
+                self.evict(name)
+            future = self.prefetching.pop((name, img2vec_path, img2ids_path), None)
+            if future is not None:
+                store = future.result()
+            else:
+                store = self.load_store(img2vec_path, img2ids_path)
+            self.stores[name] = store
+        self.enforce_budget(keep=name)
+        return store
+
+    def evict(self, name):
+        store = self.stores.pop(name, None)
+        if store is not None:
+            logger.info("release image store {} ({:.2f} GB)".format(name, store.nbytes / 1024. ** 3))
+            store.release()
+
+    @property
+    def nbytes(self):
+        return sum(store.nbytes for store in self.stores.values())
+
+    def enforce_budget(self, keep=None):
+        if self.max_bytes <= 0:
+            return
+        for name in list(self.stores.keys()):
+            if self.nbytes <= self.max_bytes:
+                break
+            if name != keep and self.stores[name].nbytes > 0:
+                logger.info("image stores over budget ({:.2f} GB)".format(self.nbytes / 1024. ** 3))
+                self.stores[name].release()
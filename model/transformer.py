@@ -428,6 +428,8 @@ class TransformerEncoder(FairseqEncoder):
             self, src_tokens, img_patch_vec, img_vec_tokens_len, token_embedding: Optional[torch.Tensor] = None
     ):
         # embed tokens and positions
+        # img_vec_tokens_len holds the positions of the image tokens, padded patches (--img-pooling concat) hold
+        # the padding index so the returned fake src_tokens give them the padding mask and padding positions
         if token_embedding is None:
             token_embedding = self.embed_tokens(src_tokens)
         token_embedding = torch.cat((token_embedding, img_patch_vec), dim=-2)
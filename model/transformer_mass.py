@@ -220,7 +220,13 @@ class MASSDecoder(TransformerDecoder):
             x = self.project_out_dim(x)
 
         if int(self.args.add_rel_margin) == 1:
-            margin_loss = get_margin_loss(encoder_out["encoder_out"][0], margin=self.args.rel_margin, img_len=self.args.patch_num, triplet_loss=self.triplet_loss)
+            img_len, encoder_padding_mask = self.args.patch_num, None
+            if getattr(self.args, "img_pooling", "mean") == "concat":
+                # the image segment is max_count * patch_num long and padded for lines with fewer images
+                img_len = encoder_out["encoder_out"][0].size()[0] - encoder_out["src_tokens"][0].size()[1]
+                encoder_padding_mask = encoder_out["encoder_padding_mask"][0]
+            margin_loss = get_margin_loss(encoder_out["encoder_out"][0], margin=self.args.rel_margin, img_len=img_len, triplet_loss=self.triplet_loss,
+                                          encoder_padding_mask=encoder_padding_mask)
 
             return x, {"attn": [attn],
                        "inner_states": inner_states,
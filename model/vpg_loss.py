@@ -107,15 +107,20 @@ def get_new_vpg_attn(encoder_self_attn, decoder_encoder_attn, encoder_padding_ma
     return visual_attn, target_patch_attn, target_source_direct_attn
 
 
-def get_margin_loss(encoder_out, margin, img_len, triplet_loss):
+def get_margin_loss(encoder_out, margin, img_len, triplet_loss, encoder_padding_mask=None):
     encoder_out = encoder_out.transpose(0, 1)
     encoder_text_len = encoder_out.size()[-2] - img_len
     text_vec = torch.mean(encoder_out[:, :encoder_text_len, :], dim=-2)
-    patch_vec = torch.mean(encoder_out[:, encoder_text_len:, :], dim=-2)
+    if encoder_padding_mask is None:
+        patch_vec = torch.mean(encoder_out[:, encoder_text_len:, :], dim=-2)
+    else:
+        # the padded patches of lines with fewer images (--img-pooling concat) are left out of the mean
+        patch_mask = (~encoder_padding_mask[:, encoder_text_len:]).unsqueeze(-1).type_as(encoder_out)
+        patch_vec = (encoder_out[:, encoder_text_len:, :] * patch_mask).sum(dim=-2) / patch_mask.sum(dim=-2).clamp(min=1)
 
-    rand_encoder_out = encoder_out[torch.randperm(encoder_out.size()[0])]
-    rand_text_vec = torch.mean(rand_encoder_out[:, :encoder_text_len, :], dim=-2)
-    rand_patch_vec = torch.mean(rand_encoder_out[:, encoder_text_len:, :], dim=-2)
+    rand_index = torch.randperm(encoder_out.size()[0])
+    rand_text_vec = text_vec[rand_index]
+    rand_patch_vec = patch_vec[rand_index]
 
     t_output = triplet_loss(text_vec, patch_vec, rand_patch_vec)
     v_output = triplet_loss(patch_vec, text_vec, rand_text_vec)
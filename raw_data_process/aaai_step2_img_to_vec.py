@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader
 import os
 import sys
 from PIL import Image
@@ -10,8 +11,18 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 import numpy as np
 from tqdm import tqdm
 import time
+import io
+import contextlib
+import traceback
 from functools import wraps
 
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+if base_path not in sys.path:
+    sys.path.insert(0, base_path)
+
+from img_feature_format import storage_np_dtype, storage_name, to_storage
+
 
 def fn_timer(function):
     @wraps(function)
@@ -28,22 +39,61 @@ def fn_timer(function):
     return function_timer
 
 
+def load_image(fp, draft_size=None):
+    """ Open an image, with draft_size JPEGs are decoded in the DCT domain at the smallest 1/2, 1/4 or 1/8
+    scale that still covers draft_size, which skips most of the decode work for large product photos
+    """
+    img = Image.open(fp)
+    if draft_size is not None:
+        img.draft('RGB', draft_size)
+    return img
+
+
+MULTI_TAPS = ('third_last', 'second_last', 'pooled')
+
+
+def to_rgb(img):
+    """ RGBA/P/L/CMYK images can not be normalized with 3 channel stats, convert them in memory """
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
 class Img2Vec():
-    def __init__(self, cuda=False, model='resnet-50', layer='default', layer_output_size=512):
+    def __init__(self, cuda=False, model='resnet-50', layer='default', layer_output_size=512, cpu_mode=None,
+                 calib_files=None, draft=False, taps=None):
         """ Img2Vec
         :param cuda: If set to True, will run forward pass on GPU
         :param model: String name of requested model
         :param layer: String or Int depending on model.  See more docs: https://github.com/christiansafka/img2vec.git
         :param layer_output_size: Int depicting the output size of the requested layer
+        :param cpu_mode: None for eager fp32, or one of 'fp32', 'bf16', 'int8' to run the 'second_last'/'third_last'
+                         extractor as a channels_last, traced and frozen graph on CPU ('bf16' under autocast,
+                         'int8' statically quantized)
+        :param calib_files: image files used to calibrate the 'int8' observers
+        :param draft: If set to True, JPEGs are decoded at reduced resolution close to 224x224 (see load_image)
+        :param taps: with layer 'multi' (resnets), the outputs taken from a single forward pass, any of
+                     'third_last' (14x14 patches), 'second_last' (7x7 patches) and 'pooled' (avgpool vector)
         """
         self.device = torch.device("cuda" if cuda else "cpu")
         self.layer_output_size = layer_output_size
         self.model_name = model
         self.layer = layer
+        self.cpu_mode = cpu_mode
+        self.draft_size = (224, 224) if draft else None
 
         self.model, self.extraction_layer = self._get_model_and_layer(model, layer)
         if self.layer in ('second_last', 'third_last'):
             self.feature_extractor = nn.Sequential(*self.extraction_layer)
+        elif self.layer == 'default' and self.model_name.startswith('resnet'):
+            # headless backbone up to avgpool, built once instead of hooking the full model per image
+            self.pooled_extractor = nn.Sequential(*list(self.model.children())[:-1])
+        elif self.layer == 'multi':
+            self.taps = tuple(taps) if taps else MULTI_TAPS
+            unknown_taps = set(self.taps) - set(MULTI_TAPS)
+            if unknown_taps:
+                raise KeyError('Taps %s were not found' % sorted(unknown_taps))
+            self.stages = [('third_last', nn.Sequential(*self.extraction_layer[:-3])),
+                           ('second_last', self.extraction_layer[-3]),
+                           ('pooled', self.extraction_layer[-2])]
 
         self.model = self.model.to(self.device)
 
@@ -53,24 +103,127 @@ class Img2Vec():
         self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                               std=[0.229, 0.224, 0.225])
         self.to_tensor = transforms.ToTensor()
+        self.preprocess = transforms.Compose([to_rgb, self.scaler, self.to_tensor, self.normalize])
+
+        if self.cpu_mode:
+            self._optimize_for_cpu(calib_files)
+
+    @property
+    def config_key(self):
+        """ Everything that changes the produced vectors, used to key feature caches """
+        return "model={},layer={},taps={},input=224x224,cpu_mode={},draft={}".format(
+            self.model_name, self.layer, ",".join(getattr(self, 'taps', ())), self.cpu_mode,
+            self.draft_size is not None)
+
+    def _autocast(self):
+        if self.cpu_mode == 'bf16':
+            return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _optimize_for_cpu(self, calib_files=None):
+        """ Internal method turning self.feature_extractor into a channels_last, traced and frozen CPU graph """
+        if self.cpu_mode not in ('fp32', 'bf16', 'int8'):
+            raise KeyError('CPU mode %s was not found' % self.cpu_mode)
+        if self.layer not in ('second_last', 'third_last'):
+            raise ValueError('cpu_mode only supports the second_last/third_last extractors, got %s' % self.layer)
+        if self.device.type != 'cpu':
+            raise ValueError('cpu_mode can not be used together with cuda')
+
+        extractor = self.feature_extractor.eval()
+        example = torch.zeros(1, 3, 224, 224).contiguous(memory_format=torch.channels_last)
+        if self.cpu_mode == 'int8':
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            if not calib_files:
+                raise ValueError('cpu_mode int8 needs calib_files to calibrate the quantization observers')
+            extractor = prepare_fx(extractor, get_default_qconfig_mapping('x86'), (example,))
+            with torch.no_grad():
+                for img_file in calib_files:
+                    try:
+                        image = self.preprocess(load_image(img_file, self.draft_size)).unsqueeze(0)
+                    except Exception:
+                        sys.stderr.write(img_file + "\t" + traceback.format_exc() + "\n")
+                        continue
+                    extractor(image)
+            extractor = convert_fx(extractor)
+        extractor = extractor.to(memory_format=torch.channels_last)
+        with torch.no_grad(), self._autocast():
+            extractor = torch.jit.freeze(torch.jit.trace(extractor, example, check_trace=False))
+            # the first calls let the profiling executor specialize the graph
+            for _ in range(2):
+                extractor(example)
+        self.feature_extractor = extractor
 
     def get_none_last_vec(self, img):
-        image = self.normalize(self.to_tensor(self.scaler(img))).unsqueeze(0).to(self.device)
-        with torch.no_grad():
-            out_features = self.feature_extractor(image)
-        out_features = out_features.permute(0, 2, 3, 1)
+        image = self.preprocess(img).unsqueeze(0)
+        return self.get_none_last_vec_batch(image)
+
+    def get_none_last_vec_batch(self, images):
+        """ Get patch vectors for a batch of preprocessed images
+        :param images: FloatTensor of shape (bs, 3, 224, 224), built with self.preprocess
+        :returns: FloatTensor of shape (bs, patch_num, feature_size)
+        """
+        images = images.to(self.device)
+        if self.cpu_mode:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad(), self._autocast():
+            out_features = self.feature_extractor(images)
+        out_features = out_features.float().permute(0, 2, 3, 1)
         bs_size = out_features.size()[0]
         feature_size = out_features.size()[-1]
         out_features = out_features.view(bs_size, -1, feature_size)
         return out_features
 
+    def get_multi_vec_batch(self, images):
+        """ Get every requested tap of layer 'multi' with one forward pass through the backbone
+        :param images: FloatTensor of shape (bs, 3, 224, 224), built with self.preprocess
+        :returns: dict of tap -> FloatTensor, (bs, patch_num, feature_size) for patch taps, (bs, feature_size) for 'pooled'
+        """
+        out = dict()
+        last_stage = max(idx for idx, (name, _) in enumerate(self.stages) if name in self.taps)
+        x = images.to(self.device)
+        with torch.no_grad():
+            for name, stage in self.stages[:last_stage + 1]:
+                x = stage(x)
+                if name not in self.taps:
+                    continue
+                if name == 'pooled':
+                    out[name] = x.flatten(1)
+                else:
+                    out[name] = x.permute(0, 2, 3, 1).reshape(x.size(0), -1, x.size(1))
+        return out
+
+    def get_vec_batch(self, images):
+        """ Get pooled vectors of a batch of preprocessed images, resnets with layer 'default' only
+        :param images: FloatTensor of shape (bs, 3, 224, 224), built with self.preprocess
+        :returns: FloatTensor of shape (bs, layer_output_size)
+        """
+        images = images.to(self.device)
+        with torch.no_grad():
+            out_features = self.pooled_extractor(images)
+        return out_features.flatten(1)
+
+    def extract_batch(self, images):
+        """ :returns: numpy vectors of a preprocessed batch: patch vectors, pooled vectors for a resnet with
+        layer 'default', or a dict of them per tap for layer 'multi'
+        """
+        if self.layer == 'multi':
+            return {name: vec.cpu().numpy() for name, vec in self.get_multi_vec_batch(images).items()}
+        if hasattr(self, 'pooled_extractor'):
+            return self.get_vec_batch(images).cpu().numpy()
+        return self.get_none_last_vec_batch(images).cpu().numpy()
+
     def get_vec(self, img, tensor=False):
         """ Get vector embedding from PIL image
         :param img: PIL Image
         :param tensor: If True, get_vec will return a FloatTensor instead of Numpy array
         :returns: Numpy ndarray
         """
-        image = self.normalize(self.to_tensor(self.scaler(img))).unsqueeze(0).to(self.device)
+        image = self.preprocess(img).unsqueeze(0).to(self.device)
+
+        if hasattr(self, 'pooled_extractor'):
+            my_embedding = self.get_vec_batch(image).view(1, self.layer_output_size, 1, 1).cpu()
+            return my_embedding if tensor else my_embedding.numpy()[0, :, :, :]
 
         if self.model_name == 'alexnet':
             my_embedding = torch.zeros(1, self.layer_output_size)
@@ -114,6 +267,8 @@ class Img2Vec():
                 layer = list(model.children())[:-2]
             elif layer == 'third_last':
                 layer = list(model.children())[:-3]
+            elif layer == 'multi':
+                layer = list(model.children())
             else:
                 layer = model._modules.get(layer)
 
@@ -138,6 +293,8 @@ class Img2Vec():
                 layer = list(model.children())[:-2]
             elif layer == 'third_last':
                 layer = list(model.children())[:-3]
+            elif layer == 'multi':
+                layer = list(model.children())
             else:
                 layer = model._modules.get(layer)
 
@@ -152,6 +309,8 @@ class Img2Vec():
                 layer = list(model.children())[:-2]
             elif layer == 'third_last':
                 layer = list(model.children())[:-3]
+            elif layer == 'multi':
+                layer = list(model.children())
             else:
                 layer = model._modules.get(layer)
 
@@ -161,6 +320,144 @@ class Img2Vec():
             raise KeyError('Model %s was not found' % model_name)
 
 
+class ImgFileDataset(Dataset):
+    """ Decode and resize image files inside DataLoader workers.
+    A broken file does not break its batch: the item comes back without image and with the traceback as error.
+    With a feature_cache the file content is hashed first and a cache hit skips decoding altogether.
+    """
+
+    def __init__(self, img_files, preprocess, feature_cache=None, draft_size=None):
+        self.img_files = img_files
+        self.preprocess = preprocess
+        self.feature_cache = feature_cache
+        self.draft_size = draft_size
+
+    def __len__(self):
+        return len(self.img_files)
+
+    def __getitem__(self, index):
+        """ :returns: (index, image tensor, cached vec, cache key, error) """
+        try:
+            if self.feature_cache is None:
+                img = load_image(self.img_files[index], self.draft_size)
+                return index, self.preprocess(img), None, None, ""
+            with open(self.img_files[index], 'rb') as f:
+                img_bytes = f.read()
+            key = self.feature_cache.content_key(img_bytes)
+            vec = self.feature_cache.get(key)
+            if vec is not None:
+                return index, None, vec, key, ""
+            img = load_image(io.BytesIO(img_bytes), self.draft_size)
+            return index, self.preprocess(img), None, key, ""
+        except Exception:
+            return index, None, None, None, traceback.format_exc()
+
+
+def collate_img_batch(items):
+    """ Keep the items of an ImgFileDataset batch apart by kind: images to run, cache hits and failures """
+    batch = {'positions': [], 'images': [], 'keys': [], 'hit_positions': [], 'hit_vecs': [], 'failed': []}
+    for index, image, vec, key, error in items:
+        if error:
+            batch['failed'].append((index, error))
+        elif vec is not None:
+            batch['hit_positions'].append(index)
+            batch['hit_vecs'].append(vec)
+        else:
+            batch['positions'].append(index)
+            batch['images'].append(image)
+            batch['keys'].append(key)
+    batch['images'] = torch.stack(batch['images']) if batch['images'] else None
+    return batch
+
+
+def iter_patch_vector_batches(img_files, img2vec, batch_size=32, num_workers=4, feature_cache=None):
+    """ Batched version of get_patch_vector_file over a list of image files
+    :param img_files: list of image file paths
+    :param img2vec: Img2Vec with a 'second_last', 'third_last' or 'multi' layer, or a resnet with layer 'default'
+                    for pooled vectors
+    :param batch_size: number of images per backbone forward
+    :param num_workers: number of decode/resize worker processes, 0 decodes in the main process
+    :param feature_cache: optional ImgFeatureCache built with img2vec.config_key, consulted before the backbone
+    :returns: generator of (positions, vecs, failed), vecs is a numpy array (len(positions), patch_num, feature_size)
+              (a dict of them per tap for layer 'multi') and failed is a list of (position, error) for files that
+              could not be decoded
+    """
+    if feature_cache is not None and img2vec.layer == 'multi':
+        raise ValueError('The feature cache only supports single layer extractors')
+    loader = DataLoader(ImgFileDataset(img_files, img2vec.preprocess, feature_cache, img2vec.draft_size),
+                        batch_size=batch_size,
+                        shuffle=False,
+                        num_workers=num_workers,
+                        collate_fn=collate_img_batch,
+                        pin_memory=img2vec.device.type == 'cuda')
+    for batch in loader:
+        positions, vecs = batch['hit_positions'], batch['hit_vecs']
+        if img2vec.layer == 'multi':
+            out_vecs = img2vec.extract_batch(batch['images']) if batch['images'] is not None else None
+            yield batch['positions'], out_vecs, batch['failed']
+            continue
+        if batch['images'] is not None:
+            out_vecs = img2vec.extract_batch(batch['images'])
+            if feature_cache is not None:
+                for key, vec in zip(batch['keys'], out_vecs):
+                    feature_cache.put(key, vec)
+            positions = positions + batch['positions']
+            vecs = vecs + list(out_vecs)
+        if not vecs:
+            yield [], None, batch['failed']
+            continue
+        order = np.argsort(positions)
+        yield [positions[i] for i in order], np.stack([vecs[i] for i in order]), batch['failed']
+
+
+class PatchVectorWriter(object):
+    """ Stream patch vectors into a preallocated .npy memmap instead of stacking them in memory.
+    The array is created on the first write, once the (patch_num, feature_size) shape of a row is known.
+    With resume=True an existing file is reopened in place so rows written by a previous run are kept.
+    dtype is the storage dtype, 'float32', 'float16' or 'bfloat16' (see data_process/feature_dtype.py).
+    """
+
+    def __init__(self, vec_np_file, row_num, dtype='float32', resume=False):
+        self.vec_np_file = vec_np_file if vec_np_file.endswith('.npy') else vec_np_file + '.npy'
+        self.row_num = row_num
+        self.dtype = storage_name(storage_np_dtype(dtype))
+        self.vec_mat = None
+        if resume and os.path.exists(self.vec_np_file):
+            self.vec_mat = np.lib.format.open_memmap(self.vec_np_file, mode='r+')
+            if self.vec_mat.shape[0] != row_num:
+                raise ValueError("Can not resume {}: it has {} rows, expected {}".format(
+                    self.vec_np_file, self.vec_mat.shape[0], row_num))
+            if storage_name(self.vec_mat.dtype) != self.dtype:
+                raise ValueError("Can not resume {}: it is stored in {}, expected {}".format(
+                    self.vec_np_file, storage_name(self.vec_mat.dtype), self.dtype))
+
+    @property
+    def shape(self):
+        return self.vec_mat.shape if self.vec_mat is not None else (self.row_num,)
+
+    def write(self, rows, vecs):
+        """ Write vecs of shape (len(rows), patch_num, feature_size) into the given rows """
+        if self.vec_mat is None:
+            self.vec_mat = np.lib.format.open_memmap(self.vec_np_file, mode='w+', dtype=storage_np_dtype(self.dtype),
+                                                     shape=(self.row_num,) + tuple(vecs.shape[1:]))
+        vecs = to_storage(vecs, self.dtype)
+        if rows[-1] - rows[0] == len(rows) - 1:
+            self.vec_mat[rows[0]: rows[-1] + 1] = vecs
+        else:
+            self.vec_mat[rows] = vecs
+
+    def flush(self):
+        if self.vec_mat is not None:
+            self.vec_mat.flush()
+
+    def close(self):
+        if self.vec_mat is None:
+            # no row shape to write a (row_num, patch_num, feature_size) matrix with, and a placeholder file
+            # would break training and pass the row check of a --resume run
+            raise ValueError("No image could be decoded, {} is not written".format(self.vec_np_file))
+        self.vec_mat.flush()
+
+
 @fn_timer
 def get_pooling_vector_dir():
     input_dir = sys.argv[1]
@@ -169,20 +466,24 @@ def get_pooling_vector_dir():
     else:
         input_name = input_dir
     input_name = input_name.split("/")[-1]
-    vec_mat = []
-    img2vec = Img2Vec(cuda=True)
-    fout = open("image_fc_names_" + input_name, "w")
-    for f in tqdm(os.listdir(input_dir)):
-        try:
-            img = Image.open(os.path.join(input_dir, f))
-            vec = img2vec.get_vec(img)
-            vec_mat.append(vec)
+    img2vec = Img2Vec(cuda=torch.cuda.is_available())
+
+    # row i of the vector file is the i-th name, images that fail to decode keep a zero row
+    img_names = os.listdir(input_dir)
+    with open("image_fc_names_" + input_name, "w") as fout:
+        for f in img_names:
             fout.write(f + "\n")
-        except:
-            print(f)
-    vec_mat = np.array(vec_mat).squeeze()
-    fout.close()
-    np.save("image_fc_vectors_" + input_name, vec_mat)
+
+    writer = PatchVectorWriter("image_fc_vectors_" + input_name, len(img_names))
+    img_files = [os.path.join(input_dir, f) for f in img_names]
+    with tqdm(total=len(img_files)) as bar:
+        for positions, vecs, failed in iter_patch_vector_batches(img_files, img2vec):
+            if positions:
+                writer.write(positions, vecs)
+            for position, error in failed:
+                print(img_names[position])
+            bar.update(len(positions) + len(failed))
+    writer.close()
 
 
 @fn_timer
@@ -193,22 +494,25 @@ def get_patch_vector_dir():
     else:
         input_name = input_dir
     input_name = input_name.split("/")[-1]
-    vec_mat = []
-    img2vec = Img2Vec(cuda=True, model='resnet-101', layer='second_last')
+    img2vec = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer='second_last')
 
-    fout = open(input_dir + "/../image_patch_names_" + input_name, "w")
-    for f in tqdm(os.listdir(input_dir)):
-        try:
-            img_file = os.path.join(input_dir, f)
-            vec = get_patch_vector_file(img_file, img2vec)
-            vec_mat.append(vec)
+    # row i of the vector file is the i-th name, images that fail to decode keep a zero row
+    img_names = os.listdir(input_dir)
+    with open(input_dir + "/../image_patch_names_" + input_name, "w") as fout:
+        for f in img_names:
             fout.write(f + "\n")
-        except:
-            print(f)
-    vec_mat = np.array(vec_mat).squeeze()
-    fout.close()
-    np.save(input_dir + "/../image_patch_vectors_" + input_name, vec_mat)
-    sys.stdout.write("The Task Is Finished! Got Numpy Data: {}\n".format(vec_mat.shape))
+
+    writer = PatchVectorWriter(input_dir + "/../image_patch_vectors_" + input_name, len(img_names))
+    img_files = [os.path.join(input_dir, f) for f in img_names]
+    with tqdm(total=len(img_files)) as bar:
+        for positions, vecs, failed in iter_patch_vector_batches(img_files, img2vec):
+            if positions:
+                writer.write(positions, vecs)
+            for position, error in failed:
+                print(img_names[position])
+            bar.update(len(positions) + len(failed))
+    writer.close()
+    sys.stdout.write("The Task Is Finished! Got Numpy Data: {}\n".format(writer.shape))
 
 
 @fn_timer
@@ -239,7 +543,7 @@ def get_patch_vector_dir_single():
 
 # @fn_timer
 def get_patch_vector_file(img_file, img2vec):
-    img = Image.open(img_file)
+    img = load_image(img_file, img2vec.draft_size)
     vec = img2vec.get_none_last_vec(img)
     vec_np = vec.cpu().numpy()
     return vec_np
@@ -247,7 +551,7 @@ def get_patch_vector_file(img_file, img2vec):
 
 @fn_timer
 def get_pooling_vector_file(img_file, img2vec):
-    img = Image.open(img_file)
+    img = load_image(img_file, img2vec.draft_size)
     vec = img2vec.get_vec(img)
     return vec
 
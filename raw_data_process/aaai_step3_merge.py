@@ -1,19 +1,112 @@
-import sys
+""" 合并多个图片特征分片
+
+Merge N image_patch_vectors_*.npy shards and their sku_map (or image_patch_names) files into one feature
+matrix, e.g. image_patch_vectors_img_merge.npy used by run_train.sh. Shards are streamed chunk by chunk into
+an output memmap, so memory stays flat whatever the shard sizes. A sku listed by several shards is kept once,
+from the first shard listing it, and img2ids files written against a shard are remapped to the merged rows.
 
+python aaai_step3_merge.py image_patch_vectors_img_merge.npy \
+    --shards image_patch_vectors_part_0.npy image_patch_vectors_part_1.npy \
+    --maps part_0.sku_map part_1.sku_map --out-map img_merge.sku_map \
+    --img2ids 0 part_0.img2ids train_0.img2ids --img2ids 1 part_1.img2ids train_1.img2ids
+"""
+
+import os
+import sys
+import argparse
 import numpy as np
+from tqdm import tqdm
+
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+sys.path.insert(0, base_path)
+
+from img_feature_format import IndexWriter
+
+
+def merge_maps(map_files):
+    """ :returns: merged keys in order of first appearance, per shard the merged row each shard row is copied to
+    (-1 when an earlier shard already provided its key), and per shard the merged row of every shard row
+    """
+    merged = dict()
+    keys = []
+    owners = []
+    remaps = []
+    for map_file in map_files:
+        shard_keys = [line.rstrip('\n') for line in open(map_file, "r", encoding="utf-8")]
+        owner = np.full(len(shard_keys), -1, dtype=np.int64)
+        remap = np.empty(len(shard_keys), dtype=np.int64)
+        for row, key in enumerate(shard_keys):
+            if key not in merged:
+                merged[key] = len(keys)
+                keys.append(key)
+                owner[row] = merged[key]
+            remap[row] = merged[key]
+        owners.append(owner)
+        remaps.append(remap)
+    return keys, owners, remaps
+
+
+def merge_shards(shard_files, map_files, output_file, out_map_file=None, chunk_rows=4096):
+    """ Stream the shards into output_file, row i of it is the i-th merged key
+    :returns: per shard the merged row of every shard row
+    """
+    assert len(shard_files) == len(map_files), "one sku_map per shard"
+    keys, owners, remaps = merge_maps(map_files)
+    shards = [np.load(shard_file, mmap_mode='r') for shard_file in shard_files]
+    for shard_file, shard, owner in zip(shard_files, shards, owners):
+        if shard.shape[1:] != shards[0].shape[1:] or shard.dtype != shards[0].dtype:
+            raise ValueError("{} is {} {}, {} is {} {}".format(shard_file, shard.shape, shard.dtype, shard_files[0],
+                                                               shards[0].shape, shards[0].dtype))
+        if len(shard) != len(owner):
+            raise ValueError("{} has {} rows, its sku_map {} lines".format(shard_file, len(shard), len(owner)))
+
+    out = np.lib.format.open_memmap(output_file, mode='w+', dtype=shards[0].dtype,
+                                    shape=(len(keys),) + shards[0].shape[1:])
+    with tqdm(total=sum(len(shard) for shard in shards)) as bar:
+        for shard, owner in zip(shards, owners):
+            for start in range(0, len(shard), chunk_rows):
+                rows = owner[start: start + chunk_rows]
+                kept = np.nonzero(rows >= 0)[0]
+                if len(kept) == len(rows) and len(kept) and rows[-1] - rows[0] == len(rows) - 1:
+                    out[rows[0]: rows[-1] + 1] = shard[start: start + len(rows)]
+                elif len(kept):
+                    out[rows[kept]] = shard[start + kept]
+                bar.update(len(rows))
+    out.flush()
+
+    if out_map_file:
+        # the text file is closed first, so the index is not older than it (see img_index.index_exists)
+        with IndexWriter(out_map_file, np.uint8) as writer, open(out_map_file, "w", encoding="utf-8") as fout:
+            for key in keys:
+                fout.write(key + "\n")
+                writer.add_str(key)
+    sys.stdout.write("Merged {} shards, {} rows, {} unique: {} {}\n".format(
+        len(shards), sum(len(shard) for shard in shards), len(keys), output_file, out.shape))
+    return remaps
+
+
+def remap_img2ids(in_file, out_file, remap):
+    """ Rewrite the ids of an img2ids file written against a shard to the merged rows """
+    with IndexWriter(out_file, np.int32) as writer, open(out_file, "w", encoding="utf-8") as fout:
+        for line in open(in_file, "r", encoding="utf-8"):
+            ids = [int(remap[int(idx)]) for idx in line.split()]
+            fout.write(" ".join(str(idx) for idx in ids) + "\n")
+            writer.add_item(ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", type=str, help="merged .npy")
+    parser.add_argument("--shards", nargs="+", required=True, help="image_patch_vectors_*.npy shards")
+    parser.add_argument("--maps", nargs="+", required=True, help="sku_map (or image_patch_names) of every shard")
+    parser.add_argument("--out-map", type=str, default=None, help="sku_map of the merged rows")
+    parser.add_argument("--img2ids", nargs=3, action="append", default=[], metavar=("SHARD", "IN", "OUT"),
+                        help="remap an img2ids file written against shard number SHARD")
+    parser.add_argument("--chunk-rows", type=int, default=4096)
+    args = parser.parse_args()
 
-input_file_1 = sys.argv[1]
-input_file_2 = sys.argv[2]
-output_file = sys.argv[3]
-
-vec1 = np.load(input_file_1)
-vec2 = np.load(input_file_2)
-vec = np.vstack((vec1, vec2))
-print(vec1.shape)
-print(vec2.shape)
-print(vec.shape)
-print(vec1[0])
-print(vec2[-1])
-print(vec[0])
-print(vec[-1])
-np.save(output_file, vec)
+    remaps = merge_shards(args.shards, args.maps, args.output, args.out_map, args.chunk_rows)
+    for shard_idx, in_file, out_file in args.img2ids:
+        remap_img2ids(in_file, out_file, remaps[int(shard_idx)])
+        sys.stdout.write("Remapped {} -> {}\n".format(in_file, out_file))
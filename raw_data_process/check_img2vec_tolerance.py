@@ -0,0 +1,121 @@
+""" Img2Vec 精度/速度检查
+
+Run an optimized Img2Vec next to the fp32 eager reference on a sample of images and report the speedup and
+how far the patch vectors drift, e.g.
+
+python check_img2vec_tolerance.py --img-dir /data/xxx/jdsum/home_appliances/img --cpu-mode int8 --num 256
+python check_img2vec_tolerance.py --img-dir /data/xxx/jdsum/home_appliances/img --draft --num 256
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+cur_path = os.path.dirname(os.path.abspath(__file__))
+base_path = os.path.dirname(cur_path)
+sys.path.insert(0, base_path)
+
+from raw_data_process.aaai_step2_img_to_vec import Img2Vec, iter_patch_vector_batches, load_image
+
+
+def compare_patch_vectors(ref, out):
+    """ Drift of out against ref, both of shape (img_num, patch_num, feature_size) """
+    diff = np.abs(ref - out)
+    ref_flat = ref.reshape(-1, ref.shape[-1])
+    out_flat = out.reshape(-1, out.shape[-1])
+    cos = (ref_flat * out_flat).sum(-1) / (np.linalg.norm(ref_flat, axis=-1) * np.linalg.norm(out_flat, axis=-1) + 1e-12)
+    return {
+        'max_abs_err': float(diff.max()),
+        'mean_abs_err': float(diff.mean()),
+        'max_rel_err': float(diff.max() / (np.abs(ref).max() + 1e-12)),
+        'min_cos': float(cos.min()),
+        'mean_cos': float(cos.mean()),
+    }
+
+
+def extract_vectors(img_files, img2vec, batch_size=32, num_workers=4):
+    """ :returns: {position: vec}, seconds spent """
+    vecs = dict()
+    t0 = time.time()
+    for positions, batch_vecs, failed in iter_patch_vector_batches(img_files, img2vec, batch_size, num_workers):
+        for position, vec in zip(positions, batch_vecs if batch_vecs is not None else []):
+            vecs[position] = vec
+    return vecs, time.time() - t0
+
+
+def report_drift(name, ref_vecs, ref_seconds, out_vecs, out_seconds, min_cos):
+    positions = sorted(set(ref_vecs) & set(out_vecs))
+    stats = compare_patch_vectors(np.stack([ref_vecs[p] for p in positions]),
+                                  np.stack([out_vecs[p] for p in positions]))
+    stats['speedup'] = ref_seconds / max(out_seconds, 1e-9)
+    stats['passed'] = stats['min_cos'] >= min_cos
+    sys.stdout.write("[{}] images: {}, ref: {:.2f}s, {}: {:.2f}s, speedup: {:.2f}x\n".format(
+        name, len(positions), ref_seconds, name, out_seconds, stats['speedup']))
+    sys.stdout.write("[{}] max_abs_err: {:.6f}, mean_abs_err: {:.6f}, max_rel_err: {:.6f}, "
+                     "min_cos: {:.6f}, mean_cos: {:.6f} -> {}\n".format(
+                         name, stats['max_abs_err'], stats['mean_abs_err'], stats['max_rel_err'],
+                         stats['min_cos'], stats['mean_cos'], "PASS" if stats['passed'] else "FAIL"))
+    return stats
+
+
+def check_cpu_mode(img_files, layer='third_last', cpu_mode='int8', batch_size=32, num_workers=4, calib_num=64,
+                   min_cos=0.99):
+    """ Tolerance report of Img2Vec(cpu_mode=...) against the fp32 eager extractor """
+    ref = Img2Vec(cuda=False, model='resnet-101', layer=layer)
+    opt = Img2Vec(cuda=False, model='resnet-101', layer=layer, cpu_mode=cpu_mode, calib_files=img_files[:calib_num])
+    ref_vecs, ref_seconds = extract_vectors(img_files, ref, batch_size, num_workers)
+    opt_vecs, opt_seconds = extract_vectors(img_files, opt, batch_size, num_workers)
+    return report_drift(cpu_mode, ref_vecs, ref_seconds, opt_vecs, opt_seconds, min_cos)
+
+
+def benchmark_decode(img_files, img2vec, draft_size=None, repeat=3):
+    """ Single thread decode + preprocess throughput in images per second """
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.time()
+        for img_file in img_files:
+            try:
+                img2vec.preprocess(load_image(img_file, draft_size))
+            except Exception:
+                pass
+        seconds.append(time.time() - t0)
+    return len(img_files) / min(seconds)
+
+
+def check_draft(img_files, layer='third_last', batch_size=32, num_workers=4, min_cos=0.99):
+    """ Decode benchmark and vector drift of Img2Vec(draft=True) against full resolution decoding """
+    ref = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer=layer)
+    opt = Img2Vec(cuda=torch.cuda.is_available(), model='resnet-101', layer=layer, draft=True)
+    full_speed = benchmark_decode(img_files, ref)
+    draft_speed = benchmark_decode(img_files, opt, opt.draft_size)
+    sys.stdout.write("[draft] decode throughput, full: {:.1f} img/s, draft: {:.1f} img/s, speedup: {:.2f}x\n".format(
+        full_speed, draft_speed, draft_speed / max(full_speed, 1e-9)))
+    ref_vecs, ref_seconds = extract_vectors(img_files, ref, batch_size, num_workers)
+    opt_vecs, opt_seconds = extract_vectors(img_files, opt, batch_size, num_workers)
+    return report_drift('draft', ref_vecs, ref_seconds, opt_vecs, opt_seconds, min_cos)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img-dir", type=str, required=True)
+    parser.add_argument("--num", type=int, default=256, help="number of images to compare")
+    parser.add_argument("--layer", choices=['second_last', 'third_last'], default='third_last')
+    parser.add_argument("--cpu-mode", choices=['fp32', 'bf16', 'int8'], default=None)
+    parser.add_argument("--calib-num", type=int, default=64, help="images used to calibrate int8")
+    parser.add_argument("--draft", action="store_true", default=False,
+                        help="benchmark reduced-resolution JPEG decoding and its vector drift")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--min-cos", type=float, default=0.99, help="lowest patch cosine similarity to pass")
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    img_files = [os.path.join(args.img_dir, f) for f in sorted(os.listdir(args.img_dir))[:args.num]]
+    if args.cpu_mode:
+        check_cpu_mode(img_files, args.layer, args.cpu_mode, args.batch_size, args.num_workers, args.calib_num,
+                       args.min_cos)
+    if args.draft:
+        check_draft(img_files, args.layer, args.batch_size, args.num_workers, args.min_cos)
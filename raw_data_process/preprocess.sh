@@ -6,8 +6,8 @@ set -u
 #name=$1
 name=home_appliances
 
-# step1: img format: RGBA -> RGB
-nohup python aaai_step1.change_rgba_to_rgb.py /data/xxx/jdsum/${name}/img > /data/xxx/jdsum/${name}/img_format_mender.log 2>&1 &
+# step1 (optional): img format: RGBA -> RGB, the patch extraction also converts images to RGB in memory
+#nohup python aaai_step1.change_rgba_to_rgb.py /data/xxx/jdsum/${name}/img > /data/xxx/jdsum/${name}/img_format_mender.log 2>&1 &
 
 # step2: img patch feature extract
-#nohup python aaai_step2_img_to_vec.py /data/xxx/jdsum/${name}/img_rgb/ > /data/xxx/jdsum/${name}/img_patch_feature.log 2>&1 &
\ No newline at end of file
+#nohup python aaai_step2_img_to_vec.py /data/xxx/jdsum/${name}/img/ > /data/xxx/jdsum/${name}/img_patch_feature.log 2>&1 &
\ No newline at end of file